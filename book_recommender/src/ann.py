@@ -0,0 +1,340 @@
+import time
+import numpy as np
+import scipy.sparse as sp
+
+
+def top_n_rows(scores, n):
+    """Returns the positions of the n highest scores in each row, best first."""
+    n = min(n, scores.shape[1])
+    if n <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.intp)
+    if n < scores.shape[1]:
+        candidates = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(
+        -np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable"
+    )
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def dot_scores(matrix, query_vectors):
+    """Dot product of each query row against every row of matrix, as a dense array."""
+    scores = matrix @ query_vectors.T
+    if sp.issparse(scores):
+        scores = scores.toarray()
+    return np.asarray(scores).T
+
+
+def dense(matrix):
+    return matrix.toarray() if sp.issparse(matrix) else np.asarray(matrix)
+
+
+def float32_rows(matrix):
+    """matrix as float32, keeping sparse matrices sparse."""
+    if sp.issparse(matrix):
+        return matrix.astype(np.float32)
+    return np.asarray(matrix, dtype=np.float32)
+
+
+class ExactIndex:
+    """Brute-force search over every row; the reference for approximate indexes."""
+
+    exact = True
+
+    def __init__(self, block_size=256):
+        self.block_size = block_size
+
+    def build(self, matrix):
+        self.matrix = matrix
+        return self
+
+    def search(self, query_vector, top_n):
+        # Not self.search_batch: subclasses fall back to this exact search
+        top, scores = ExactIndex.search_batch(self, query_vector, top_n)
+        return top[0], scores[0]
+
+    def search_batch(self, query_vectors, top_n):
+        """Top-N rows for every query row, scored a block of queries at a time."""
+        top_n = min(top_n, self.matrix.shape[0])
+        num_queries = query_vectors.shape[0]
+        top = np.empty((num_queries, top_n), dtype=np.intp)
+        top_scores = np.empty((num_queries, top_n))
+        for start in range(0, num_queries, self.block_size):
+            stop = start + self.block_size
+            scores = dot_scores(self.matrix, query_vectors[start:stop])
+            top[start:stop] = top_n_rows(scores, top_n)
+            top_scores[start:stop] = np.take_along_axis(scores, top[start:stop], axis=1)
+        return top, top_scores
+
+
+class RandomProjectionIndex(ExactIndex):
+    """Random-projection LSH: rows sharing a sign pattern over random hyperplanes
+    land in the same bucket, and only the buckets a query falls into are scored.
+
+    n_probes is the recall/latency knob: each table also probes the buckets
+    reached by flipping the query's least confident bits. Catalogs smaller than
+    exact_below are searched exactly, as is any query whose buckets hold fewer
+    than top_n books.
+
+    Rows wider than sketch_dim, such as TF-IDF rows over a large vocabulary, are
+    first feature-hashed down to sketch_dim columns (each feature adds to one
+    column with a random sign), so the hyperplanes stay sketch_dim tall instead
+    of one float per feature per bit.
+    """
+
+    def __init__(
+        self,
+        n_tables=8,
+        n_bits=None,
+        n_probes=4,
+        bucket_size=64,
+        sketch_dim=1024,
+        exact_below=20000,
+        seed=42,
+    ):
+        super().__init__()
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.bucket_size = bucket_size
+        self.sketch_dim = sketch_dim
+        self.exact_below = exact_below
+        self.seed = seed
+        self.tables = []
+
+    @property
+    def exact(self):
+        return not self.tables
+
+    def build(self, matrix):
+        self.matrix = matrix
+        self.tables = []
+        num_rows = matrix.shape[0]
+        if num_rows < self.exact_below:
+            return self
+        # Enough bits that a bucket holds about bucket_size rows as the catalog grows
+        bits = self.n_bits or int(np.log2(max(num_rows / self.bucket_size, 2)))
+        self.bits = min(max(bits, 1), 62)
+        self.bit_weights = np.left_shift(1, np.arange(self.bits, dtype=np.int64))
+        rng = np.random.default_rng(self.seed)
+        num_features = matrix.shape[1]
+        self.sketch = None
+        if num_features > self.sketch_dim:
+            signs = rng.choice(np.array([-1, 1], dtype=np.float32), num_features)
+            columns = rng.integers(0, self.sketch_dim, num_features)
+            self.sketch = sp.csr_matrix(
+                (signs, columns, np.arange(num_features + 1)),
+                shape=(num_features, self.sketch_dim),
+            )
+            num_features = self.sketch_dim
+        self.planes = rng.standard_normal(
+            (num_features, self.n_tables * self.bits)
+        ).astype(np.float32)
+        codes = self._codes(self._project(matrix))
+        for t in range(self.n_tables):
+            order = np.argsort(codes[:, t], kind="stable")
+            keys, starts = np.unique(codes[order, t], return_index=True)
+            bounds = np.append(starts, num_rows)
+            self.tables.append((keys, bounds, order.astype(np.int32)))
+        return self
+
+    def _project(self, vectors):
+        # Cast the (small) vectors, not the planes, so no projection-sized copy is made
+        vectors = float32_rows(vectors)
+        if self.sketch is not None:
+            vectors = vectors @ self.sketch
+        return np.asarray(vectors @ self.planes).reshape(
+            vectors.shape[0], self.n_tables, self.bits
+        )
+
+    def _codes(self, projections):
+        return (projections > 0).astype(np.int64) @ self.bit_weights
+
+    def candidates(self, query_vector):
+        """Row positions sharing a probed bucket with the query, in any table."""
+        projection = self._project(query_vector)
+        codes = self._codes(projection)[0]
+        flips = np.argsort(np.abs(projection[0]), axis=1)[:, : self.n_probes - 1]
+        probes = np.column_stack([codes, codes[:, None] ^ self.bit_weights[flips]])
+        members = []
+        for (keys, bounds, rows), table_probes in zip(self.tables, probes):
+            positions = np.searchsorted(keys, table_probes).clip(max=len(keys) - 1)
+            positions = positions[keys[positions] == table_probes]
+            members.extend(rows[bounds[p] : bounds[p + 1]] for p in positions)
+        if not members:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(members))
+
+    def search(self, query_vector, top_n):
+        if not self.tables:
+            return super().search(query_vector, top_n)
+        candidates = self.candidates(query_vector)
+        if len(candidates) < top_n:
+            return super().search(query_vector, top_n)
+        scores = dot_scores(self.matrix[candidates], query_vector)
+        top = top_n_rows(scores, top_n)[0]
+        return candidates[top], scores[0, top]
+
+    def search_batch(self, query_vectors, top_n):
+        if not self.tables:
+            return super().search_batch(query_vectors, top_n)
+        # Every query probes its own buckets, so there is no shared product to batch
+        results = [
+            self.search(query_vectors[i : i + 1], top_n)
+            for i in range(query_vectors.shape[0])
+        ]
+        top = np.array([found for found, _ in results], dtype=np.intp)
+        top_scores = np.array([scores for _, scores in results])
+        return top.reshape(len(results), -1), top_scores.reshape(len(results), -1)
+
+
+class InvertedFileIndex(ExactIndex):
+    """Inverted-file index for maximum inner product search: k-means splits the
+    rows into lists, and a query only scores the lists that could hold its best
+    rows.
+
+    Unlike RandomProjectionIndex, which finds the rows at the smallest angle to
+    the query, lists are ranked by inner product, so rows with long vectors are
+    not missed. oversample is the recall/latency knob: lists are visited until
+    they hold oversample * top_n rows. Catalogs smaller than exact_below are
+    searched exactly. Rows may be dense or sparse; only the centroids are dense.
+    """
+
+    def __init__(
+        self,
+        n_lists=None,
+        oversample=32,
+        iterations=10,
+        exact_below=20000,
+        seed=42,
+    ):
+        super().__init__()
+        self.n_lists = n_lists
+        self.oversample = oversample
+        self.iterations = iterations
+        self.exact_below = exact_below
+        self.seed = seed
+        self.centroids = None
+
+    @property
+    def exact(self):
+        return self.centroids is None
+
+    def build(self, matrix):
+        self.matrix = matrix
+        self.centroids = None
+        num_rows = matrix.shape[0]
+        if num_rows < self.exact_below:
+            return self
+        n_lists = min(self.n_lists or int(3 * np.sqrt(num_rows)), num_rows)
+        rng = np.random.default_rng(self.seed)
+        # k-means on a sample: about 30 rows per list is enough to place centroids
+        picked = rng.choice(num_rows, min(num_rows, 30 * n_lists), replace=False)
+        sample = float32_rows(matrix[np.sort(picked)])
+        num_samples = sample.shape[0]
+        positions = np.arange(num_samples)
+        centroids = dense(sample[rng.choice(num_samples, n_lists, replace=False)])
+        for _ in range(self.iterations):
+            assignment = self._assign(sample, centroids)
+            ones = np.ones(num_samples, dtype=np.float32)
+            members = sp.csr_matrix(
+                (ones, (assignment, positions)), shape=(n_lists, num_samples)
+            )
+            counts = np.asarray(members.sum(axis=1))
+            centroids = np.where(
+                counts > 0, dense(members @ sample) / np.maximum(counts, 1), centroids
+            ).astype(np.float32)
+        assignment = self._assign(matrix, centroids)
+        order = np.argsort(assignment, kind="stable")
+        self.bounds = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        self.rows = order.astype(np.int32)
+        self.centroids = centroids
+        return self
+
+    @staticmethod
+    def _assign(vectors, centroids, block_size=8192):
+        """Nearest centroid of each row."""
+        assignment = np.empty(vectors.shape[0], dtype=np.intp)
+        # The nearest centroid maximizes row . c - |c|^2 / 2
+        half_norms = 0.5 * (centroids**2).sum(axis=1)
+        for start in range(0, vectors.shape[0], block_size):
+            rows = float32_rows(vectors[start : start + block_size])
+            scores = np.asarray(rows @ centroids.T)
+            scores -= half_norms
+            assignment[start : start + block_size] = np.argmax(scores, axis=1)
+        return assignment
+
+    def probed_lists(self, query_vectors, top_n):
+        """The lists each query visits, most promising first, as (lists, counts)."""
+        scores = np.asarray(float32_rows(query_vectors) @ self.centroids.T)
+        ranked = np.argsort(-scores, axis=1)
+        gathered = np.diff(self.bounds)[ranked].cumsum(axis=1)
+        counts = (gathered < self.oversample * top_n).sum(axis=1) + 1
+        return ranked, np.minimum(counts, ranked.shape[1])
+
+    def search_batch(self, query_vectors, top_n):
+        if self.centroids is None:
+            return super().search_batch(query_vectors, top_n)
+        top_n = min(top_n, self.matrix.shape[0])
+        ranked, counts = self.probed_lists(query_vectors, top_n)
+        top = np.empty((query_vectors.shape[0], top_n), dtype=np.intp)
+        top_scores = np.empty((query_vectors.shape[0], top_n))
+        for i, (lists, count) in enumerate(zip(ranked, counts)):
+            candidates = np.concatenate(
+                [self.rows[self.bounds[j] : self.bounds[j + 1]] for j in lists[:count]]
+            )
+            scores = dot_scores(self.matrix[candidates], query_vectors[i : i + 1])
+            best = top_n_rows(scores, top_n)[0]
+            top[i], top_scores[i] = candidates[best], scores[0, best]
+        return top, top_scores
+
+    def search(self, query_vector, top_n):
+        top, scores = self.search_batch(query_vector, top_n)
+        return top[0], scores[0]
+
+
+def measure_recall(index, reference, query_vectors, top_n=5):
+    """Average recall@top_n of index against reference, with mean query latencies."""
+    recalls, index_time, reference_time = [], 0.0, 0.0
+    for i in range(query_vectors.shape[0]):
+        query = query_vectors[i : i + 1]
+        start = time.perf_counter()
+        found, _ = index.search(query, top_n)
+        index_time += time.perf_counter() - start
+        start = time.perf_counter()
+        expected, _ = reference.search(query, top_n)
+        reference_time += time.perf_counter() - start
+        if len(expected):
+            recalls.append(len(np.intersect1d(found, expected)) / len(expected))
+    num_queries = max(query_vectors.shape[0], 1)
+    return {
+        "recall": float(np.mean(recalls)) if recalls else 1.0,
+        "index_ms": 1000 * index_time / num_queries,
+        "exact_ms": 1000 * reference_time / num_queries,
+    }
+
+
+if __name__ == "__main__":
+    from database import get_all_books
+    from content_based import ContentBasedRecommender
+
+    recommender = ContentBasedRecommender(get_all_books())
+    sample = np.random.default_rng(0).choice(
+        len(recommender.books_df),
+        size=min(200, len(recommender.books_df)),
+        replace=False,
+    )
+    queries = recommender.tfidf.transform(
+        recommender.books_df["description"].iloc[sample].str.slice(0, 200)
+    )
+    exact = ExactIndex().build(recommender.tfidf_matrix)
+    print(f"{recommender.tfidf_matrix.shape[0]} books, {len(sample)} queries, top 5")
+    for n_probes in (1, 2, 4, 8, 16):
+        index = RandomProjectionIndex(n_probes=n_probes, exact_below=0)
+        index.build(recommender.tfidf_matrix)
+        result = measure_recall(index, exact, queries)
+        print(
+            f"n_probes={n_probes:<3} recall@5={result['recall']:.3f} "
+            f"lsh={result['index_ms']:.2f}ms exact={result['exact_ms']:.2f}ms"
+        )
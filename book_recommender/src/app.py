@@ -2,11 +2,12 @@ import streamlit as st
 import os
 import time
 import pandas as pd
-import torch
-from torch.utils.data import DataLoader
 from preprocessing import load_data, prepare_data_for_nn
 from content_based import ContentBasedRecommender
-from neural_network import RecommenderNet, BookDataset, train_model
+from ann import RandomProjectionIndex
+from catalog import BookCatalog
+from neural_network import TwoStageRecommender
+from trainer import ensure_trainer_running, latest_version, load_serving_model
 from database import (
     create_user,
     add_rating,
@@ -14,6 +15,10 @@ from database import (
     get_user_ratings,
     get_system_stats,
     get_book_average_rating,
+    get_book_average_ratings,
+    get_trending_book_ids,
+    get_user_recommendations,
+    request_training,
 )
 import numpy as np
 import random
@@ -516,16 +521,17 @@ st.markdown(
 def load_and_prep_data():
     books, ratings = load_data()
     valid_ids = get_valid_user_ids()
-    ratings, num_users, num_books, user2user_encoded, book2book_encoded = (
-        prepare_data_for_nn(ratings)
+    ratings, num_users, num_books, user_encoder, book_encoder = prepare_data_for_nn(
+        ratings
     )
     return (
         books,
+        BookCatalog(books),
         ratings,
         num_users,
         num_books,
-        user2user_encoded,
-        book2book_encoded,
+        user_encoder,
+        book_encoder,
         valid_ids,
     )
 
@@ -566,60 +572,33 @@ def render_loading_screen(progress, message):
     )
 
 
-@st.cache_resource
-def train_nn_model(
-    ratings, num_users, num_books, _progress_callback=None, force_retrain=False
-):
-    model_path = os.path.join(os.path.dirname(__file__), "../data/model.pth")
-    model = RecommenderNet(num_users, num_books)
-    meta_path = os.path.join(os.path.dirname(__file__), "../data/model_metadata.json")
-    should_retrain = force_retrain
-    if not should_retrain and os.path.exists(model_path) and os.path.exists(meta_path):
-        try:
-            import json
+@st.cache_resource(max_entries=2)
+def load_neural_picks(version, num_users, num_books, _ratings):
+    model = load_serving_model(version, num_users, num_books)
+    if model is None:
+        return None
+    popularity = np.bincount(_ratings["book_encoded"], minlength=num_books)
+    return TwoStageRecommender(model, popularity)
 
-            with open(meta_path, "r") as f:
-                meta = json.load(f)
-            if meta.get("num_ratings") != len(ratings):
-                should_retrain = True
-                print(
-                    f"Data changed ({meta.get('num_ratings')} -> {len(ratings)} ratings). Retraining..."
-                )
-        except:
-            should_retrain = True
-    if not should_retrain and os.path.exists(model_path):
-        try:
-            model.load_state_dict(torch.load(model_path))
-            model.eval()
-            if _progress_callback:
-                _progress_callback(5, 5)  # Show 100%
-            return model
-        except Exception as e:
-            print(f"Error loading model: {e}")
-    dataset = BookDataset(
-        ratings["user_encoded"].values,
-        ratings["book_encoded"].values,
-        ratings["rating"].values,
-    )
-    train_loader = DataLoader(dataset, batch_size=32, shuffle=True)
-    train_model(model, train_loader, epochs=5, progress_callback=_progress_callback)
-    try:
-        torch.save(model.state_dict(), model_path)
-    except Exception as e:
-        print(f"Error saving model: {e}")
-    try:
-        import json
 
-        with open(meta_path, "w") as f:
-            json.dump({"num_ratings": len(ratings)}, f)
-    except Exception as e:
-        print(f"Error saving metadata: {e}")
-    return model
+def get_neural_picks(ratings, num_users, num_books):
+    """(version, recommender); the recommender is None until a model is usable."""
+    ensure_trainer_running()
+    version = latest_version()
+    picks = None
+    if version is not None:
+        picks = load_neural_picks(version, num_users, num_books, ratings)
+    if picks is None:
+        request_training("no usable model", full_retrain=True)
+    return version, picks
 
 
 @st.cache_resource
 def get_content_model_v4(books):
-    return ContentBasedRecommender(books)
+    cache_dir = os.path.join(os.path.dirname(__file__), "../data/content_cache")
+    return ContentBasedRecommender(
+        books, ann_index=RandomProjectionIndex(), cache_dir=cache_dir
+    )
 
 
 def render_book_card(
@@ -712,10 +691,12 @@ def get_user_favorite_genre(user_id, ratings, books):
     return top_genre
 
 
-def render_book_details_page(book_id, books, ratings, content_model):
+def render_book_details_page(book_id, catalog, content_model):
     try:
-        book = books[books["book_id"] == int(book_id)].iloc[0]
-    except:
+        book = catalog.get(int(book_id))
+    except ValueError:
+        book = None
+    if book is None:
         st.error("Book not found.")
         return
     if st.button("← Back to Dashboard"):
@@ -797,7 +778,7 @@ def render_book_details_page(book_id, books, ratings, content_model):
     recs = content_model.get_recommendations(book["title"])
     cols = st.columns(4)
     for i, (rec_title, score) in enumerate(recs[:4]):
-        rec_book = books[books["title"] == rec_title].iloc[0]
+        rec_book = catalog.get_by_title(rec_title)
         with cols[i]:
             st.markdown(
                 render_book_card(
@@ -875,47 +856,35 @@ def main():
     with st.spinner("Loading System..."):
         (
             books,
+            catalog,
             ratings,
             num_users,
             num_books,
-            user2user_encoded,
-            book2book_encoded,
+            user_encoder,
+            book_encoder,
             valid_user_ids,
         ) = load_and_prep_data()
+        # Load the exported model once per server, before anyone signs in
+        get_neural_picks(ratings, num_users, num_books)
     if "book_id" in st.query_params:
         book_id = st.query_params["book_id"]
         content_model = get_content_model_v4(books)
-        render_book_details_page(book_id, books, ratings, content_model)
+        render_book_details_page(book_id, catalog, content_model)
         return
     if st.session_state.get("loading_in_progress"):
 
 
-        def update_progress(current, total):
-            p = 0.2 + (current / total) * 0.7
-            render_loading_screen(
-                p, f"Fine-tuning Neural Network (Epoch {current}/{total})..."
-            )
-
         render_loading_screen(0.1, "Initializing User Profile...")
         time.sleep(0.3)  # Small delay for visual smoothness
         render_loading_screen(0.2, "Checking for Saved Brain...")
-        time.sleep(0.3)
-        force_retrain = st.session_state.get("force_retrain", False)
-        if force_retrain:
+        if st.session_state.get("force_retrain", False):
             st.session_state.force_retrain = False  # Reset flag
-            train_nn_model(
-                ratings,
-                num_users,
-                num_books,
-                _progress_callback=update_progress,
-                force_retrain=True,
-            )
-        else:
-            model = train_nn_model(ratings, num_users, num_books, force_retrain=False)
-            for i in range(20, 91, 5):
-                p = i / 100.0
-                render_loading_screen(p, "Loading Neural Network...")
-                time.sleep(0.05)  # Fast but visible smooth fill
+            request_training("retrain requested", full_retrain=True)
+        get_neural_picks(ratings, num_users, num_books)
+        for i in range(20, 91, 5):
+            p = i / 100.0
+            render_loading_screen(p, "Loading Neural Network...")
+            time.sleep(0.05)  # Fast but visible smooth fill
         render_loading_screen(0.9, "Finalizing Content Models...")
         get_content_model_v4(books)
         time.sleep(0.3)
@@ -941,8 +910,10 @@ def main():
         login_page(valid_user_ids)
     else:
         st.query_params["user_id"] = str(st.session_state.user_id)
-        with st.spinner("Fine-tuning Neural Network..."):
-            nn_model = train_nn_model(ratings, num_users, num_books)
+        with st.spinner("Loading Neural Network..."):
+            model_version, neural_picks = get_neural_picks(
+                ratings, num_users, num_books
+            )
         with st.spinner("Analyzing Content Features..."):
             content_model = get_content_model_v4(books)
         st.markdown(
@@ -1025,12 +996,13 @@ def main():
                 '<div class="section-desc">The top 10 most popular books in our community right now.</div>',
                 unsafe_allow_html=True,
             )
-            top_book_ids = ratings["book_id"].value_counts().head(10).index
+            top_book_ids = get_trending_book_ids(10)
+            live_avgs = get_book_average_ratings(top_book_ids)
             cols = st.columns(3, gap="large")
             for i, book_id in enumerate(top_book_ids):
-                book_info = books[books["book_id"] == book_id].iloc[0]
+                book_info = catalog.get(book_id)
                 col_idx = i % 3
-                live_avg = get_book_average_rating(book_id)
+                live_avg = live_avgs[book_id]
                 with cols[col_idx]:
                     st.markdown(
                         render_book_card(
@@ -1055,30 +1027,31 @@ def main():
                 '<div class="section-desc">Deep learning predictions based on your unique reading history and similar users.</div>',
                 unsafe_allow_html=True,
             )
-            user_encoded = user2user_encoded.get(user_id)
-            if user_encoded is not None:
-                all_book_ids = torch.tensor(
-                    list(book2book_encoded.values()), dtype=torch.long
+            user_encoded = user_encoder.get(user_id)
+            if neural_picks is None:
+                st.info(
+                    "The neural engine is still training. Check back in a few minutes!"
                 )
-                user_tensor = torch.tensor(
-                    [user_encoded] * len(all_book_ids), dtype=torch.long
-                )
-                nn_model.eval()
-                with torch.no_grad():
-                    predictions = nn_model(user_tensor, all_book_ids).squeeze()
-                top_indices = predictions.argsort(descending=True)[:3].numpy()
-                encoded2book = {v: k for k, v in book2book_encoded.items()}
+            elif user_encoded is not None:
+                precomputed = get_user_recommendations(model_version, user_id, 3)
+                if precomputed:
+                    top_book_ids = [book_id for book_id, _ in precomputed]
+                    predictions = [score for _, score in precomputed]
+                else:
+                    # Users who rated since the last training run aren't in the table
+                    top_indices, predictions = neural_picks.recommend(user_encoded, 3)
+                    top_book_ids = book_encoder.decode(top_indices).tolist()
                 fav_genre = get_user_favorite_genre(user_id, ratings, books)
                 explanation_text = (
                     f"Matches your interest in {fav_genre}"
                     if fav_genre
                     else "Trending among similar users"
                 )
+                live_avgs = get_book_average_ratings(top_book_ids)
                 cols = st.columns(3)
-                for i, idx in enumerate(top_indices):
-                    book_id = encoded2book[idx]
-                    book_info = books[books["book_id"] == book_id].iloc[0]
-                    live_avg = get_book_average_rating(int(book_id))
+                for i, book_id in enumerate(top_book_ids):
+                    book_info = catalog.get(book_id)
+                    live_avg = live_avgs[book_id]
                     with cols[i]:
                         st.markdown(
                             render_book_card(
@@ -1087,7 +1060,7 @@ def main():
                                 book_info.get("genres"),
                                 book_info["description"],
                                 book_info.get("image_url"),
-                                predictions[idx],
+                                predictions[i],
                                 is_prediction=True,
                                 explanation=explanation_text,
                                 avg_rating=live_avg,
@@ -1111,17 +1084,17 @@ def main():
                 top_book_id = user_ratings.sort_values("rating", ascending=False).iloc[
                     0
                 ]["book_id"]
-                top_book_title = books[books["book_id"] == top_book_id]["title"].values[
-                    0
-                ]
+                top_book_title = catalog.get(top_book_id)["title"]
                 st.info(f"Because you enjoyed **{top_book_title}**")
                 recs_with_scores = content_model.get_recommendations(top_book_title)
                 recs_with_scores = recs_with_scores[:3]
+                rec_books = [catalog.get_by_title(title) for title, _ in recs_with_scores]
+                live_avgs = get_book_average_ratings([b["book_id"] for b in rec_books])
                 cols = st.columns(3)
                 for i, (rec_title, score) in enumerate(recs_with_scores):
-                    book_info = books[books["title"] == rec_title].iloc[0]
+                    book_info = rec_books[i]
                     match_percentage = f"{int(score * 100)}% Match"
-                    live_avg = get_book_average_rating(int(book_info["book_id"]))
+                    live_avg = live_avgs[book_info["book_id"]]
                     with cols[i]:
                         st.markdown(
                             render_book_card(
@@ -1168,11 +1141,15 @@ def main():
                     )
                 st.session_state["run_desc_search"] = False
                 if desc_recs:
+                    rec_books = [catalog.get_by_title(title) for title, _ in desc_recs]
+                    live_avgs = get_book_average_ratings(
+                        [b["book_id"] for b in rec_books]
+                    )
                     cols = st.columns(3)
                     for i, (rec_title, score) in enumerate(desc_recs):
-                        book_info = books[books["title"] == rec_title].iloc[0]
+                        book_info = rec_books[i]
                         match_percentage = f"{int(score * 100)}% Match"
-                        live_avg = get_book_average_rating(int(book_info["book_id"]))
+                        live_avg = live_avgs[book_info["book_id"]]
                         with cols[i]:
                             st.markdown(
                                 render_book_card(
@@ -1210,12 +1187,13 @@ def main():
                 if not results.empty:
                     st.write(f"Found {len(results)} books matching '{rate_search}':")
                     user_ratings_map = get_user_ratings(user_id)
+                    avg_ratings = get_book_average_ratings(results["book_id"])
                     cols = st.columns(3, gap="large")
                     for i, (_, book) in enumerate(results.iterrows()):
                         col_idx = i % 3
                         book_id = int(book["book_id"])
                         existing_rating = user_ratings_map.get(book_id)
-                        avg_rating = get_book_average_rating(book_id)
+                        avg_rating = avg_ratings[book_id]
                         with cols[col_idx]:
                             with st.form(f"rating_form_{book_id}"):
                                 st.markdown(
@@ -0,0 +1,55 @@
+import os
+import shutil
+import time
+
+# Temp directories older than this are left over from a process that died mid-write
+STALE_TMP_SECONDS = 3600
+
+
+def publish_directory(path, write, keep=1, order_key=os.path.getmtime):
+    """Has write(tmp_path) fill a private temp directory, then moves it in as path.
+
+    Paths name their contents, so a path that already exists, possibly published
+    by another process meanwhile, is kept as it is: readers may have its files
+    memory-mapped. Afterwards only the newest `keep` sibling directories, ranked
+    by order_key, survive. Other processes' in-progress .tmp- directories are
+    never pruned, unless they are old enough to be abandoned.
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(path):
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            write(tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+                # Another process published the same contents first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+    prune_directories(parent, keep, order_key, current=path)
+
+
+def prune_directories(parent, keep, order_key, current=None):
+    published, now = [], time.time()
+    for entry in os.listdir(parent):
+        entry_path = os.path.join(parent, entry)
+        if not os.path.isdir(entry_path):
+            continue
+        try:
+            if ".tmp-" not in entry:
+                published.append((order_key(entry_path), entry_path))
+            elif now - os.path.getmtime(entry_path) > STALE_TMP_SECONDS:
+                shutil.rmtree(entry_path, ignore_errors=True)
+        except OSError:
+            continue  # Removed by another process meanwhile
+    published.sort(reverse=True)
+    survivors = {entry_path for _, entry_path in published[:keep]}
+    survivors.add(current)
+    for _, entry_path in published:
+        if entry_path not in survivors:
+            shutil.rmtree(entry_path, ignore_errors=True)
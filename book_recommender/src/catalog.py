@@ -0,0 +1,35 @@
+class BookCatalog:
+    """Books indexed by book_id and by title, with every field kept as a column array."""
+
+    def __init__(self, books_df):
+        self.books_df = books_df
+        self.columns = {
+            column: books_df[column].to_numpy() for column in books_df.columns
+        }
+        for column in ("author", "description"):
+            self.columns[column] = books_df[column].fillna("").to_numpy()
+        self.positions_by_id = {
+            book_id: i for i, book_id in enumerate(books_df["book_id"].tolist())
+        }
+        # Duplicate titles resolve to their first row, as a boolean mask would
+        self.positions_by_title = {}
+        for i, title in enumerate(books_df["title"].tolist()):
+            self.positions_by_title.setdefault(title, i)
+
+    def __len__(self):
+        return len(self.books_df)
+
+    def __contains__(self, book_id):
+        return book_id in self.positions_by_id
+
+    def row(self, position):
+        return {column: values[position] for column, values in self.columns.items()}
+
+    def get(self, book_id):
+        """The book's fields as a dict, or None for an unknown book_id."""
+        position = self.positions_by_id.get(book_id)
+        return None if position is None else self.row(position)
+
+    def get_by_title(self, title):
+        position = self.positions_by_title.get(title)
+        return None if position is None else self.row(position)
@@ -1,65 +1,472 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+from sklearn.preprocessing import normalize
+from ann import ExactIndex, dot_scores, top_n_rows
+from artifacts import publish_directory
+
+ARTIFACT_VERSION = 2
+# Larger batches skip the result cache unless asked: they would evict the hot entries
+MAX_CACHED_BATCH = 64
+
+
+def minmax_scores(raw_scores, low=0.82, high=0.96):
+    """Rescales each row of raw similarities onto [low, high].
+
+    Deterministic, so identical queries give identical, cacheable results.
+    """
+    max_score = raw_scores.max(axis=-1, keepdims=True, initial=-np.inf)
+    min_score = raw_scores.min(axis=-1, keepdims=True, initial=np.inf)
+    span = max_score - min_score
+    scaled = (raw_scores - min_score) / np.where(span > 0, span, 1.0)
+    return np.where(span > 0, low + scaled * (high - low), 0.95)
+
+
+def jittered_scores(raw_scores, rng=np.random):
+    """Like minmax_scores, but with the bounds of each row drawn at random."""
+    num_rows = raw_scores.shape[0]
+    high = 0.99 - rng.uniform(0, 0.07, size=(num_rows, 1))
+    low = 0.80 + rng.uniform(0, 0.05, size=(num_rows, 1))
+    return minmax_scores(raw_scores, low, high)
+
+
+SCORE_NORMALIZERS = {"minmax": minmax_scores, "jitter": jittered_scores}
+
+
+class ResultCache:
+    """Thread-safe LRU cache bounded by entry count, with an optional TTL in seconds."""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """get for several keys under a single acquisition of the lock."""
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None:
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        with self._lock:
+            now = time.monotonic()
+            for key, value in items:
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+def _row_hashes(books_df):
+    return pd.util.hash_pandas_object(
+        books_df[["book_id", "title", "content"]], index=False
+    ).to_numpy()
+
+
+def books_fingerprint(books_df, neighbors_k):
+    """Hash of everything a fitted content model depends on."""
+    digest = hashlib.sha1(_row_hashes(books_df).tobytes())
+    digest.update(f"v{ARTIFACT_VERSION}-k{neighbors_k}".encode())
+    return digest.hexdigest()
 
 
 class ContentBasedRecommender:
-    def __init__(self, books_df):
+    def __init__(
+        self,
+        books_df,
+        neighbors_k=50,
+        block_size=256,
+        ann_index=None,
+        cache_dir=None,
+        idf_refresh_ratio=0.1,
+        score_normalization="minmax",
+        cache_size=1024,
+        cache_ttl=None,
+    ):
         self.books_df = books_df
         self.tfidf_matrix = None
         self.indices = None
+        self.neighbors_k = neighbors_k
+        self.block_size = block_size
+        self.neighbor_indices = None
+        self.neighbor_scores = None
+        self.ann_index = ann_index if ann_index is not None else ExactIndex()
+        self.cache_dir = cache_dir
+        self.idf_refresh_ratio = idf_refresh_ratio
+        # A name from SCORE_NORMALIZERS, or any function of a 2-D score array
+        if score_normalization in SCORE_NORMALIZERS:
+            score_normalization = SCORE_NORMALIZERS[score_normalization]
+        elif not callable(score_normalization):
+            raise ValueError(
+                f"Unknown score_normalization {score_normalization!r}; expected one "
+                f"of {sorted(SCORE_NORMALIZERS)} or a callable"
+            )
+        self.score_normalization = score_normalization
+        self.result_cache = ResultCache(cache_size, cache_ttl)
         self._prepare_model()
 
     def _prepare_model(self):
-        self.books_df["description"] = self.books_df["description"].fillna("")
-        self.books_df["author"] = self.books_df["author"].fillna("")
-        self.books_df["content"] = (
-            self.books_df["author"] + " " + self.books_df["description"]
-        )
+        self._set_books(self.books_df)
+        artifact_path = self._artifact_path()
+        latest_path = self._latest_artifact()
+        books_df = self.books_df
+        try:
+            if artifact_path and os.path.isdir(artifact_path):
+                self._load_artifact(artifact_path)
+                self.ann_index.build(self.tfidf_matrix)
+                return
+            if latest_path:
+                # Books changed since the last run: start from the old model
+                # and vectorize only the difference
+                self._load_artifact(latest_path)
+                if self.neighbor_indices.shape[1] == self._neighbor_count():
+                    self._splice_books(books_df)
+                    self._save_artifact()
+                    self.ann_index.build(self.tfidf_matrix)
+                    return
+        except Exception as e:
+            print(f"Error loading content model cache: {e}")
+        self._set_books(books_df)
+        self._fit()
+        self._save_artifact()
+        self.ann_index.build(self.tfidf_matrix)
+
+    def _set_books(self, books_df):
+        books_df["description"] = books_df["description"].fillna("")
+        books_df["author"] = books_df["author"].fillna("")
+        books_df["content"] = books_df["author"] + " " + books_df["description"]
+        self.books_df = books_df
+        self.indices = pd.Series(np.arange(len(books_df)), index=books_df["title"])
+        self.indices = self.indices[~self.indices.index.duplicated()]
+        self._titles = books_df["title"].to_numpy()
+
+    def _fit(self):
+        self.result_cache.clear()
         self.tfidf = TfidfVectorizer(stop_words="english")
         self.tfidf_matrix = self.tfidf.fit_transform(self.books_df["content"])
-        self.indices = pd.Series(
-            self.books_df.index, index=self.books_df["title"]
-        ).drop_duplicates()
+        self._book_ids = self.books_df["book_id"].to_numpy()
+        self._row_hashes = _row_hashes(self.books_df)
+        self._stale_rows = 0
+        self._build_neighbor_index()
+
+    def update_books(self, books_df):
+        """Vectorizes only the new or changed rows of books_df and splices them
+        into the model, keeping the fitted vocabulary. IDF weights are refreshed
+        once more than idf_refresh_ratio of the rows were added this way.
+        Returns the number of rows vectorized.
+        """
+        updated = self._splice_books(books_df)
+        if updated:
+            self._save_artifact()
+            self.ann_index.build(self.tfidf_matrix)
+        return updated
+
+    def _splice_books(self, books_df):
+        known_ids = pd.Index(self._book_ids)
+        self._set_books(books_df)
+        row_hashes = _row_hashes(books_df)
+        positions = known_ids.get_indexer(books_df["book_id"])
+        known = positions >= 0
+        touched = ~known
+        touched[known] = self._row_hashes[positions[known]] != row_hashes[known]
+        if known.sum() < len(known_ids):
+            # Removed books shift every row; start over
+            self._fit()
+            return len(books_df)
+        if not touched.any():
+            return 0
+        self.result_cache.clear()
+        new_vectors = self.tfidf.transform(books_df["content"][touched])
+        rows = np.where(touched, len(known_ids) + np.cumsum(touched) - 1, positions)
+        matrix = sp.vstack([self.tfidf_matrix, new_vectors], format="csr")
+        if not np.array_equal(rows, np.arange(len(rows))):
+            matrix = matrix[rows]
+        carried = np.full(len(known_ids), -1)
+        carried[positions[~touched]] = np.flatnonzero(~touched)
+        old_neighbors = (
+            carried[self.neighbor_indices[positions[~touched]]],
+            self.neighbor_scores[positions[~touched]],
+        )
+        self.tfidf_matrix = matrix
+        self._book_ids = books_df["book_id"].to_numpy()
+        self._row_hashes = row_hashes
+        self._stale_rows += int(touched.sum())
+        if self._stale_rows > self.idf_refresh_ratio * len(books_df):
+            self._refresh_idf()
+        else:
+            self._merge_neighbors(touched, *old_neighbors)
+        return int(touched.sum())
+
+    def add_books(self, new_books_df):
+        """Appends new_books_df to the catalog; see update_books."""
+        books_df = pd.concat([self.books_df, new_books_df], ignore_index=True)
+        return self.update_books(books_df)
+
+    def _refresh_idf(self):
+        """Recomputes IDF from the current rows and re-weights them, without a refit.
+
+        Terms first seen after the last fit stay out of the vocabulary until then.
+        """
+        num_docs, num_terms = self.tfidf_matrix.shape
+        doc_freq = np.bincount(self.tfidf_matrix.indices, minlength=num_terms)
+        # TfidfVectorizer's smooth_idf formula
+        idf = np.log((1 + num_docs) / (1 + doc_freq)) + 1
+        matrix = self.tfidf_matrix @ sp.diags(idf / self.tfidf.idf_)
+        self.tfidf_matrix = normalize(matrix, copy=False).tocsr()
+        self.tfidf.idf_ = idf
+        self._stale_rows = 0
+        self._build_neighbor_index()
+
+    def _artifact_path(self):
+        if not self.cache_dir:
+            return None
+        fingerprint = books_fingerprint(self.books_df, self.neighbors_k)
+        return os.path.join(self.cache_dir, fingerprint)
+
+    def _latest_artifact(self):
+        if not self.cache_dir:
+            return None
+        try:
+            entries = os.listdir(self.cache_dir)
+        except OSError:
+            return None
+        artifacts = []
+        for entry in entries:
+            if ".tmp-" in entry:
+                continue
+            path = os.path.join(self.cache_dir, entry)
+            try:
+                artifacts.append((os.path.getmtime(path), path))
+            except OSError:
+                continue  # Pruned by another process meanwhile
+        return max(artifacts, default=(None, None))[1]
+
+    def _save_artifact(self):
+        """Writes the fitted model as .npy arrays, then swaps the directory in whole."""
+        path = self._artifact_path()
+        if not path:
+            return
+        try:
+            arrays = {
+                "data": self.tfidf_matrix.data,
+                "indices": self.tfidf_matrix.indices,
+                "indptr": self.tfidf_matrix.indptr,
+                "shape": np.array(self.tfidf_matrix.shape),
+                "idf": self.tfidf.idf_,
+                "vocabulary": self.tfidf.get_feature_names_out().astype(str),
+                "neighbor_indices": self.neighbor_indices,
+                "neighbor_scores": self.neighbor_scores,
+                "book_ids": self._book_ids,
+                "row_hashes": self._row_hashes,
+                "stale_rows": np.array(self._stale_rows),
+            }
+
+            def write(tmp_path):
+                for name, array in arrays.items():
+                    np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+
+            # Only the newest artifact is worth keeping
+            publish_directory(path, write)
+        except Exception as e:
+            print(f"Error saving content model cache: {e}")
+
+    def _load_artifact(self, path):
+        """Memory-maps a saved model; nothing is refitted."""
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.tfidf_matrix = sp.csr_matrix(
+            (load("data"), load("indices"), load("indptr")),
+            shape=tuple(load("shape")),
+        )
+        vocabulary = load("vocabulary")
+        self.tfidf = TfidfVectorizer(stop_words="english")
+        self.tfidf.vocabulary_ = dict(zip(vocabulary.tolist(), range(len(vocabulary))))
+        self.tfidf.idf_ = np.asarray(load("idf"))
+        self.neighbor_indices = load("neighbor_indices")
+        self.neighbor_scores = load("neighbor_scores")
+        self._book_ids = load("book_ids")
+        self._row_hashes = load("row_hashes")
+        self._stale_rows = int(load("stale_rows"))
+
+    def _neighbor_count(self):
+        return min(self.neighbors_k, max(len(self.books_df) - 1, 0))
+
+    def _build_neighbor_index(self):
+        """Stores the K most similar books of every book."""
+        num_books = self.tfidf_matrix.shape[0]
+        k = self._neighbor_count()
+        self.neighbor_indices = np.empty((num_books, k), dtype=np.int32)
+        self.neighbor_scores = np.empty((num_books, k), dtype=np.float32)
+        self._fill_neighbor_rows(np.arange(num_books))
+
+    def _fill_neighbor_rows(self, rows):
+        k = self.neighbor_indices.shape[1]
+        for _, block_rows, top, scores in self._scored_neighbors(rows, k):
+            self.neighbor_indices[block_rows] = top
+            self.neighbor_scores[block_rows] = scores
+
+    def _scored_neighbors(self, rows, k):
+        """Scores the given rows against the catalog, one block of rows at a time."""
+        for start in range(0, len(rows), self.block_size):
+            block_rows = rows[start : start + self.block_size]
+            block = dot_scores(self.tfidf_matrix, self.tfidf_matrix[block_rows])
+            # A book is not its own neighbor
+            block[np.arange(len(block_rows)), block_rows] = -np.inf
+            top = top_n_rows(block, k)
+            yield start, block_rows, top, np.take_along_axis(block, top, axis=1)
+
+    def _merge_neighbors(self, touched, carried_indices, carried_scores):
+        """Updates the neighbor index after the touched rows were (re)vectorized.
+
+        Untouched rows keep their lists and only score the touched rows; rows
+        whose list pointed at a changed book are rescored in full.
+        """
+        num_books = self.tfidf_matrix.shape[0]
+        k = self._neighbor_count()
+        if k != carried_indices.shape[1]:
+            self._build_neighbor_index()
+            return
+        self.neighbor_indices = np.empty((num_books, k), dtype=np.int32)
+        self.neighbor_scores = np.empty((num_books, k), dtype=np.float32)
+        touched_rows = np.flatnonzero(touched)
+        untouched_rows = np.flatnonzero(~touched)
+        stale = (carried_indices < 0).any(axis=1)
+        keep_rows = untouched_rows[~stale]
+        carried_indices = carried_indices[~stale]
+        carried_scores = carried_scores[~stale]
+        touched_matrix = self.tfidf_matrix[touched_rows]
+        for start in range(0, len(keep_rows), self.block_size):
+            stop = start + self.block_size
+            block_rows = keep_rows[start:stop]
+            fresh = dot_scores(touched_matrix, self.tfidf_matrix[block_rows])
+            indices = np.hstack(
+                [
+                    carried_indices[start:stop],
+                    np.broadcast_to(touched_rows, fresh.shape),
+                ]
+            )
+            scores = np.hstack([carried_scores[start:stop], fresh])
+            top = top_n_rows(scores, k)
+            self.neighbor_indices[block_rows] = np.take_along_axis(indices, top, axis=1)
+            self.neighbor_scores[block_rows] = np.take_along_axis(scores, top, axis=1)
+        self._fill_neighbor_rows(np.concatenate([touched_rows, untouched_rows[stale]]))
 
     def get_recommendations(self, title, top_n=5):
-        if title not in self.indices:
-            return []
-        idx = self.indices[title]
-        cosine_sim = linear_kernel(self.tfidf_matrix, self.tfidf_matrix)
-        sim_scores = list(enumerate(cosine_sim[idx]))
-        sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
-        sim_scores = sim_scores[1 : top_n + 1]
-        return self._process_scores(sim_scores)
+        return self.get_recommendations_batch([title], top_n)[0]
+
+    def get_recommendations_batch(self, titles, top_n=5, use_cache=None):
+        """get_recommendations for many titles in one pass; unknown titles get [].
+
+        use_cache=None caches only batches of up to MAX_CACHED_BATCH titles.
+        """
+        return self._cached("title", titles, top_n, self._recommend_titles, use_cache)
+
+    def _recommend_titles(self, titles, top_n):
+        positions = self.indices.reindex(titles).to_numpy()
+        known = np.flatnonzero(pd.notna(positions))
+        book_indices, scores = self._neighbors_of(
+            positions[known].astype(np.intp), top_n
+        )
+        results = [[] for _ in range(len(positions))]
+        for i, row in zip(known, self._process_scores(book_indices, scores)):
+            results[i] = row
+        return results
+
+    def _neighbors_of(self, rows, top_n):
+        """Top-N neighbors of the given rows, read from the index when deep enough."""
+        if top_n <= self.neighbor_indices.shape[1]:
+            return (
+                self.neighbor_indices[rows, :top_n],
+                self.neighbor_scores[rows, :top_n],
+            )
+        # Deeper than the index: score these rows against the catalog
+        top_n = min(top_n, self.tfidf_matrix.shape[0] - 1)
+        book_indices = np.empty((len(rows), top_n), dtype=np.intp)
+        scores = np.empty((len(rows), top_n))
+        for start, block_rows, top, top_scores in self._scored_neighbors(rows, top_n):
+            book_indices[start : start + len(block_rows)] = top
+            scores[start : start + len(block_rows)] = top_scores
+        return book_indices, scores
 
     def recommend_by_description(self, description, top_n=5):
-        description_vector = self.tfidf.transform([description])
-        cosine_sim = linear_kernel(description_vector, self.tfidf_matrix)
-        sim_scores = list(enumerate(cosine_sim[0]))
-        sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
-        sim_scores = sim_scores[:top_n]
-        return self._process_scores(sim_scores)
-
-    def _process_scores(self, sim_scores):
-        book_indices = [i[0] for i in sim_scores]
-        raw_scores = [i[1] for i in sim_scores]
-        if raw_scores:
-            max_score = max(raw_scores)
-            min_score = min(raw_scores)
-            if max_score == min_score:
-                scores = [0.95 for _ in raw_scores]
-            else:
-                import random
-
-                target_max = 0.99 - random.uniform(0, 0.07)
-                target_min = 0.80 + random.uniform(0, 0.05)
-                scores = [
-                    target_min
-                    + ((s - min_score) / (max_score - min_score))
-                    * (target_max - target_min)
-                    for s in raw_scores
-                ]
-        else:
-            scores = []
-        titles = self.books_df["title"].iloc[book_indices].tolist()
-        return list(zip(titles, scores))
+        return self.recommend_by_description_batch([description], top_n)[0]
+
+    def recommend_by_description_batch(self, descriptions, top_n=5, use_cache=None):
+        """recommend_by_description for many texts, vectorized in one transform.
+
+        use_cache is as for get_recommendations_batch.
+        """
+        return self._cached(
+            "description", descriptions, top_n, self._recommend_descriptions, use_cache
+        )
+
+    def _recommend_descriptions(self, descriptions, top_n):
+        description_vectors = self.tfidf.transform(descriptions)
+        book_indices, scores = self.ann_index.search_batch(description_vectors, top_n)
+        return self._process_scores(book_indices, scores)
+
+    def _cached(self, kind, queries, top_n, compute, use_cache=None):
+        """Serves queries from the result cache, computing the misses in one batch."""
+        if use_cache is None:
+            use_cache = len(queries) <= MAX_CACHED_BATCH
+        if not use_cache:
+            return compute(list(queries), top_n)
+        keys = [(kind, query, top_n) for query in queries]
+        # Cached as tuples and handed out as fresh lists, so callers that modify
+        # their results cannot change what later callers get
+        results = [
+            None if cached is None else list(cached)
+            for cached in self.result_cache.get_many(keys)
+        ]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            computed = compute([queries[i] for i in missing], top_n)
+            for i, result in zip(missing, computed):
+                results[i] = result
+            self.result_cache.put_many([(keys[i], tuple(results[i])) for i in missing])
+        return results
+
+    def _process_scores(self, book_indices, raw_scores):
+        """Turns rows of (book index, raw score) into rows of (title, display score)."""
+        scores = self.score_normalization(np.asarray(raw_scores, dtype=np.float64))
+        titles = self._titles[book_indices]
+        return [
+            list(zip(row_titles, row_scores))
+            for row_titles, row_scores in zip(titles.tolist(), scores.tolist())
+        ]
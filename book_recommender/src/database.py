@@ -1,82 +1,451 @@
 import sqlite3
 import pandas as pd
+import io
+import multiprocessing
 import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "../data/library.db")
 DATA_DIR = os.path.join(os.path.dirname(__file__), "../data")
+POOL_SIZE = 8
+IMPORT_CHUNK_BYTES = 4 << 20  # About 150k Book-Crossing ratings
+IMPORT_WORKERS = os.cpu_count() or 1
+BOOK_COLUMNS = [
+    "original_id",
+    "title",
+    "author",
+    "year",
+    "publisher",
+    "image_url",
+    "description",
+    "genres",
+    "average_rating",
+]
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",  # Readers no longer block on a writer, or it on them
+    "PRAGMA synchronous = NORMAL",  # Durable under WAL except on power loss
+    "PRAGMA cache_size = -16000",  # 16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",  # Read pages straight from a 256 MB mapping
+    "PRAGMA temp_store = MEMORY",
+)
 
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    """Opens a new connection with the WAL journal and tuned pragmas applied."""
+    # Pooled connections move between Streamlit's script threads, one at a time
+    conn = sqlite3.connect(
+        DB_PATH, timeout=30, check_same_thread=False, cached_statements=256
+    )
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+class ConnectionPool:
+    """A bounded set of long-lived connections, each used by one thread at a time.
+
+    Keeping connections open skips the per-call connect and pragma setup and lets
+    each connection reuse its cache of prepared statements.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = get_db_connection()
+            yield conn
+        finally:
+            if conn is not None:
+                # Never hand the next caller a half-finished transaction
+                if conn.in_transaction:
+                    conn.rollback()
+                self.idle.put(conn)
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def db_connection():
+    """Borrows a pooled connection: `with db_connection() as conn: ...`."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_PATH)
+        pool = _pool
+    return pool.connection()
+
+
 def init_db():
     """Initializes the database and populates it if empty."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+        )
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS books (
+            book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            original_id TEXT, -- Stores ISBN or original ID
+            title TEXT,
+            author TEXT,
+            year INTEGER,
+            publisher TEXT,
+            image_url TEXT,
+            description TEXT,
+            genres TEXT,
+            average_rating REAL DEFAULT 0.0
+        )
+        """
+        )
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS ratings (
+            rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            book_id INTEGER,
+            rating INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            change_seq INTEGER NOT NULL DEFAULT 0, -- data_version of the last upsert
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (book_id) REFERENCES books (book_id)
+        )
+        """
+        )
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS import_progress (
+            source TEXT PRIMARY KEY,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0
+        )
+        """
+        )
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            version INTEGER NOT NULL,
+            books_version INTEGER NOT NULL DEFAULT 1
+        )
+        """
+        )
+        cursor.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (0, 1)")
+        add_missing_column(
+            conn, "data_version", "books_version", "INTEGER NOT NULL DEFAULT 1"
+        )
+        if add_missing_column(
+            conn, "ratings", "change_seq", "INTEGER NOT NULL DEFAULT 0"
+        ):
+            # Snapshots taken without the column are out of date
+            bump_data_version(conn)
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS training_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reason TEXT,
+            full_retrain INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """
+        )
+        cursor.execute(
+            """
+        CREATE TABLE IF NOT EXISTS user_recommendations (
+            model_version INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            book_id INTEGER NOT NULL,
+            score REAL,
+            PRIMARY KEY (model_version, user_id, rank)
+        ) WITHOUT ROWID
+        """
+        )
+        create_rating_stats(cursor)
+        conn.commit()
+        if import_pending(conn):
+            print("Database empty. Importing data from CSVs...")
+            import_data(conn)
+        create_ratings_indexes(conn)
+        cursor.execute("SELECT count(*) FROM book_rating_stats")
+        if cursor.fetchone()[0] == 0:
+            refresh_rating_stats(conn)
+
+
+def add_missing_column(conn, table, column, definition):
+    """Adds a column to a table created before it existed; True if it was added."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+def create_ratings_indexes(conn):
+    """Indexes ratings by (user_id, book_id), which is unique, and by book_id.
+
+    The composite index also serves lookups by user_id alone.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_ratings_user_book'"
+    ).fetchone()
+    if not exists:
+        create_unique = (
+            "CREATE UNIQUE INDEX idx_ratings_user_book ON ratings (user_id, book_id)"
+        )
+        try:
+            conn.execute(create_unique)
+        except sqlite3.IntegrityError:
+            # Older databases may repeat a user's rating of a book; keep the latest
+            conn.execute(
+                """
+                DELETE FROM ratings WHERE rating_id NOT IN (
+                    SELECT MAX(rating_id) FROM ratings GROUP BY user_id, book_id
+                )
+            """
+            )
+            conn.execute(create_unique)
+            bump_data_version(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ratings_book ON ratings (book_id)")
+    # Lets a snapshot fetch just the ratings changed since it was taken
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_ratings_change_seq ON ratings (change_seq)"
+    )
+    conn.commit()
+
+
+def create_rating_stats(cursor):
+    """Per-book rating aggregates, kept current by triggers on every ratings write."""
     cursor.execute(
         """
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    CREATE TABLE IF NOT EXISTS book_rating_stats (
+        book_id INTEGER PRIMARY KEY,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum INTEGER NOT NULL DEFAULT 0,
+        average_rating REAL NOT NULL DEFAULT 0.0,
+        FOREIGN KEY (book_id) REFERENCES books (book_id)
     )
     """
     )
     cursor.execute(
         """
-    CREATE TABLE IF NOT EXISTS books (
-        book_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        original_id TEXT, -- Stores ISBN or original ID
-        title TEXT,
-        author TEXT,
-        year INTEGER,
-        publisher TEXT,
-        image_url TEXT,
-        description TEXT,
-        genres TEXT,
-        average_rating REAL DEFAULT 0.0
+    CREATE INDEX IF NOT EXISTS idx_book_rating_stats_count
+    ON book_rating_stats (rating_count DESC)
+    """
     )
+    add_new_rating = """
+        INSERT INTO book_rating_stats (book_id, rating_count, rating_sum, average_rating)
+        VALUES (NEW.book_id, 1, NEW.rating, NEW.rating)
+        ON CONFLICT (book_id) DO UPDATE SET
+            rating_count = rating_count + 1,
+            rating_sum = rating_sum + NEW.rating,
+            average_rating = (rating_sum + NEW.rating) * 1.0 / (rating_count + 1);
+    """
+    remove_old_rating = """
+        UPDATE book_rating_stats SET
+            rating_count = rating_count - 1,
+            rating_sum = rating_sum - OLD.rating,
+            average_rating = CASE WHEN rating_count > 1
+                THEN (rating_sum - OLD.rating) * 1.0 / (rating_count - 1)
+                ELSE 0.0 END
+        WHERE book_id = OLD.book_id;
+    """
+    cursor.execute(
+        f"""
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_insert AFTER INSERT ON ratings
+    BEGIN {add_new_rating} END
     """
     )
     cursor.execute(
-        """
-    CREATE TABLE IF NOT EXISTS ratings (
-        rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        book_id INTEGER,
-        rating INTEGER,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (user_id),
-        FOREIGN KEY (book_id) REFERENCES books (book_id)
+        f"""
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_update
+    AFTER UPDATE OF book_id, rating ON ratings
+    BEGIN {remove_old_rating} {add_new_rating} END
+    """
     )
+    cursor.execute(
+        f"""
+    CREATE TRIGGER IF NOT EXISTS ratings_stats_delete AFTER DELETE ON ratings
+    BEGIN {remove_old_rating} END
     """
     )
+
+
+def refresh_rating_stats(conn):
+    """Rebuilds book_rating_stats from scratch out of the ratings table."""
+    # A sorted full scan beats visiting every row through the book_id index
+    conn.execute("DELETE FROM book_rating_stats")
+    conn.execute(
+        """
+        INSERT INTO book_rating_stats (book_id, rating_count, rating_sum, average_rating)
+        SELECT book_id, COUNT(rating), SUM(rating), AVG(rating)
+        FROM ratings NOT INDEXED GROUP BY book_id
+    """
+    )
+    conn.commit()
+
+
+def bump_data_version(conn, books=False):
+    """Marks ratings, and books too if they changed, as out of date in snapshots."""
+    conn.execute(
+        "UPDATE data_version SET version = version + 1, "
+        "books_version = books_version + ? WHERE id = 0",
+        (int(books),),
+    )
+
+
+def get_data_version():
+    with db_connection() as conn:
+        row = conn.execute("SELECT version FROM data_version WHERE id = 0").fetchone()
+    return row[0]
+
+
+def get_books_version():
+    """Like get_data_version, but only bumped when the books change."""
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT books_version FROM data_version WHERE id = 0"
+        ).fetchone()
+    return row[0]
+
+
+def import_pending(conn):
+    """True while the books table is empty or an earlier import did not finish."""
+    if conn.execute("SELECT count(*) FROM books").fetchone()[0] == 0:
+        return True
+    unfinished = conn.execute("SELECT 1 FROM import_progress WHERE done = 0").fetchone()
+    return unfinished is not None
+
+
+@contextmanager
+def import_pragmas(conn):
+    """Skips fsyncs and widens the page cache for the duration of a bulk load."""
+    # A crash mid-load is safe to retry: progress is only recorded once committed
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -256000")
+    try:
+        yield
+    finally:
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+
+
+def drop_ratings_indexes(conn):
+    """Drops the ratings indexes and stats triggers so a bulk load skips their upkeep.
+
+    import_data recreates both, and rebuilds the stats, once the rows are in.
+    """
+    for index in (
+        "idx_ratings_user_book",
+        "idx_ratings_book",
+        "idx_ratings_change_seq",
+    ):
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+    for trigger in (
+        "ratings_stats_insert",
+        "ratings_stats_update",
+        "ratings_stats_delete",
+    ):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
     conn.commit()
-    cursor.execute("SELECT count(*) FROM books")
-    if cursor.fetchone()[0] == 0:
-        print("Database empty. Importing data from CSVs...")
-        import_data(conn)
-    conn.close()
 
 
 def import_data(conn):
-    """Imports data from CSVs into SQLite, handling different schemas."""
+    """Bulk-loads the CSVs into SQLite, resuming after the last committed chunk."""
     books_path = os.path.join(DATA_DIR, "books.csv")
     ratings_path = os.path.join(DATA_DIR, "ratings.csv")
     users_path = os.path.join(DATA_DIR, "users.csv")  # Optional
     if not os.path.exists(books_path):
         print("No books.csv found!")
         return
-    df_books = pd.read_csv(books_path, nrows=5, on_bad_lines="skip")
-    columns = df_books.columns.tolist()
+    sources = ["books"] + (["ratings"] if os.path.exists(ratings_path) else [])
+    conn.executemany(
+        "INSERT OR IGNORE INTO import_progress (source) VALUES (?)",
+        [(source,) for source in sources],
+    )
+    conn.commit()
+    progress = {
+        source: (rows_done, done)
+        for source, rows_done, done in conn.execute(
+            "SELECT source, rows_done, done FROM import_progress"
+        )
+    }
+    drop_ratings_indexes(conn)
+    with import_pragmas(conn):
+        if not progress["books"][1]:
+            import_books(conn, books_path)
+        if "ratings" in progress and not progress["ratings"][1]:
+            import_ratings(conn, ratings_path, progress["ratings"][0])
+        print("Building Indexes...")
+        create_ratings_indexes(conn)
+        create_rating_stats(conn.cursor())
+        refresh_rating_stats(conn)
+        bump_data_version(conn, books=True)
+        print("Syncing Users...")
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO users (user_id, username)
+            SELECT DISTINCT user_id, 'User ' || user_id FROM ratings
+        """
+        )
+        conn.commit()
+    print("Data Import Complete.")
+
+
+def report_rate(what, count, started):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"Imported {count} {what} in {elapsed:.1f}s ({count / elapsed:,.0f} rows/s).")
+
+
+def import_books(conn, books_path):
+    """Inserts every book in one transaction, marking the books import done with it."""
+    # Only the header is needed to tell the schemas apart
+    columns = pd.read_csv(books_path, nrows=0).columns.tolist()
     print("Importing Books...")
+    started = time.perf_counter()
     if "ISBN" in columns and "Book-Title" in columns:
         real_books = pd.read_csv(
-            books_path, on_bad_lines="skip", dtype={"Year-Of-Publication": str}
+            books_path,
+            on_bad_lines="skip",
+            dtype={"ISBN": str, "Year-Of-Publication": str},
         )
         real_books = real_books.rename(
             columns={
@@ -94,180 +463,488 @@ def import_data(conn):
         real_books["year"] = (
             pd.to_numeric(real_books["year"], errors="coerce").fillna(0).astype(int)
         )
-        db_books = real_books[
-            [
-                "original_id",
-                "title",
-                "author",
-                "year",
-                "publisher",
-                "image_url",
-                "description",
-                "genres",
-                "average_rating",
-            ]
-        ]
-        db_books.to_sql("books", conn, if_exists="append", index=False)
-        print(f"Imported {len(db_books)} books (Kaggle Schema).")
+        schema = "Kaggle"
     elif "book_id" in columns and "title" in columns:
         real_books = pd.read_csv(books_path)
         real_books = real_books.rename(columns={"book_id": "original_id"})
         real_books["year"] = 0
         real_books["publisher"] = "Unknown"
-        db_books = real_books[
-            [
-                "original_id",
-                "title",
-                "author",
-                "year",
-                "publisher",
-                "image_url",
-                "description",
-                "genres",
-                "average_rating",
-            ]
-        ]
-        db_books.to_sql("books", conn, if_exists="append", index=False)
-        print(f"Imported {len(db_books)} books (Goodreads Schema).")
-    print("Importing Ratings...")
-    if os.path.exists(ratings_path):
-        df_ratings = pd.read_csv(ratings_path, nrows=5)
-        r_columns = df_ratings.columns.tolist()
-        book_map = pd.read_sql("SELECT original_id, book_id FROM books", conn)
-        id_map = dict(zip(book_map["original_id"].astype(str), book_map["book_id"]))
-        if "User-ID" in r_columns and "ISBN" in r_columns:
-            chunk_size = 100000
-            for chunk in pd.read_csv(
-                ratings_path, chunksize=chunk_size, on_bad_lines="skip"
-            ):
-                chunk = chunk.rename(
-                    columns={
-                        "User-ID": "user_id",
-                        "ISBN": "original_id",
-                        "Book-Rating": "rating",
-                    }
-                )
-                chunk["original_id"] = chunk["original_id"].astype(str)
-                chunk["book_id"] = chunk["original_id"].map(id_map)
-                chunk = chunk.dropna(
-                    subset=["book_id"]
-                )  # Drop ratings for missing books
-                chunk[["user_id", "book_id", "rating"]].to_sql(
-                    "ratings", conn, if_exists="append", index=False
-                )
-                print(f"Imported chunk of ratings...")
-        elif "user_id" in r_columns and "book_id" in r_columns:
-            real_ratings = pd.read_csv(ratings_path)
-            real_ratings["book_id"] = real_ratings["book_id"].astype(str).map(id_map)
-            real_ratings = real_ratings.dropna(subset=["book_id"])
-            real_ratings[["user_id", "book_id", "rating"]].to_sql(
-                "ratings", conn, if_exists="append", index=False
-            )
-            print(f"Imported {len(real_ratings)} ratings.")
-    print("Syncing Users...")
+        schema = "Goodreads"
+    else:
+        print(f"Unrecognised books.csv columns: {columns}")
+        return
+    db_books = real_books[BOOK_COLUMNS].astype(object)
+    db_books = db_books.where(db_books.notna(), None)
+    conn.executemany(
+        f"INSERT INTO books ({', '.join(BOOK_COLUMNS)}) "
+        f"VALUES ({', '.join('?' * len(BOOK_COLUMNS))})",
+        db_books.itertuples(index=False, name=None),
+    )
     conn.execute(
-        """
-        INSERT OR IGNORE INTO users (user_id, username)
-        SELECT DISTINCT user_id, 'User ' || user_id FROM ratings
+        "UPDATE import_progress SET rows_done = ?, done = 1 WHERE source = 'books'",
+        (len(db_books),),
+    )
+    conn.commit()
+    report_rate(f"books ({schema} Schema)", len(db_books), started)
+
+
+def ratings_columns(columns):
+    """Maps the ratings CSV's columns onto user_id, original_id and rating."""
+    if "User-ID" in columns and "ISBN" in columns:
+        return {"User-ID": "user_id", "ISBN": "original_id", "Book-Rating": "rating"}
+    if "user_id" in columns and "book_id" in columns:
+        return {"user_id": "user_id", "book_id": "original_id", "rating": "rating"}
+    return None
+
+
+def load_book_id_index(conn):
+    """An index of original IDs and the book_ids they translate to."""
+    book_map = pd.read_sql("SELECT original_id, book_id FROM books", conn)
+    # Repeated original IDs resolve to the last book, as the old dict did
+    book_map = book_map.drop_duplicates("original_id", keep="last")
+    return pd.Index(book_map["original_id"].astype(str)), book_map["book_id"].to_numpy()
+
+
+def map_ratings_chunk(chunk, id_index, book_ids):
+    """(user_id, book_id, rating) rows for a chunk, dropping unknown books."""
+    positions = id_index.get_indexer(chunk["original_id"].astype(str))
+    user_ids = pd.to_numeric(chunk["user_id"], errors="coerce").to_numpy(float)
+    ratings = pd.to_numeric(chunk["rating"], errors="coerce").to_numpy(float)
+    known = (positions >= 0) & ~np.isnan(user_ids) & ~np.isnan(ratings)
+    rows = np.column_stack(
+        [user_ids[known], book_ids[positions[known]], ratings[known]]
+    )
+    return rows.astype(np.int64)
+
+
+def write_ratings_chunk(conn, rows, rows_read):
+    """Commits a chunk of ratings together with the number of CSV rows read so far."""
+    # Rows go through a temp table so AUTOINCREMENT is maintained once per chunk
+    conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS ratings_staging "
+        "(user_id INTEGER, book_id INTEGER, rating INTEGER)"
+    )
+    conn.executemany("INSERT INTO temp.ratings_staging VALUES (?, ?, ?)", rows.tolist())
+    conn.execute(
+        "INSERT INTO ratings (user_id, book_id, rating) "
+        "SELECT user_id, book_id, rating FROM temp.ratings_staging"
+    )
+    conn.execute("DELETE FROM temp.ratings_staging")
+    conn.execute(
+        "UPDATE import_progress SET rows_done = ? WHERE source = 'ratings'",
+        (rows_read,),
+    )
+    conn.commit()
+
+
+def skip_lines(path, count):
+    """Byte offset just past the header line and the count lines after it."""
+    with open(path, "rb") as f:
+        f.readline()
+        offset = f.tell()
+        while count:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            if block.count(b"\n") < count:
+                count -= block.count(b"\n")
+                offset += len(block)
+                continue
+            end = -1
+            for _ in range(count):
+                end = block.index(b"\n", end + 1)
+            offset += end + 1
+            count = 0
+    return offset
+
+
+def line_ranges(path, start, chunk_bytes):
+    """Splits a file from byte offset start into ranges that end on a line break.
+
+    Ratings rows never span lines, so each range parses on its own.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            yield start, f.tell()
+            start = f.tell()
+
+
+_ratings_worker = {}
+
+
+def init_ratings_worker(path, columns, renames, id_index, book_ids):
+    _ratings_worker.update(
+        path=path,
+        columns=columns,
+        renames=renames,
+        id_index=id_index,
+        book_ids=book_ids,
+    )
+
+
+def parse_ratings_range(byte_range):
+    """Parses and maps one byte range of the ratings CSV, in a worker process.
+
+    Returns the mapped rows and the number of lines the range held.
     """
+    worker = _ratings_worker
+    start, end = byte_range
+    with open(worker["path"], "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if not data.strip():
+        return np.empty((0, 3), dtype=np.int64), data.count(b"\n")
+    renames = worker["renames"]
+    id_column = next(column for column in renames if renames[column] == "original_id")
+    chunk = pd.read_csv(
+        io.BytesIO(data),
+        header=None,
+        names=worker["columns"],
+        usecols=list(renames),
+        # All-digit ISBNs would otherwise lose their leading zeros in some chunks
+        dtype={id_column: str},
+        on_bad_lines="skip",
+    )
+    rows = map_ratings_chunk(
+        chunk.rename(columns=renames), worker["id_index"], worker["book_ids"]
     )
+    return rows, data.count(b"\n")
+
+
+class RatingsWriter(threading.Thread):
+    """The one thread that writes to SQLite, committing batches in file order."""
+
+    def __init__(self, conn, rows_done, max_pending):
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.rows_done = rows_done
+        # Bounded, so parsing stalls instead of piling up rows when writes fall behind
+        self.batches = queue.Queue(maxsize=max_pending)
+        self.imported = 0
+        self.error = None
+        self.started = time.perf_counter()
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue  # Keep draining so the producer never blocks on a full queue
+            rows, lines = batch
+            try:
+                write_ratings_chunk(self.conn, rows, self.rows_done + lines)
+            except Exception as e:
+                self.error = e
+                continue
+            self.rows_done += lines
+            self.imported += len(rows)
+            rate = self.imported / max(time.perf_counter() - self.started, 1e-9)
+            print(f"Imported {self.imported} ratings ({rate:,.0f} rows/s)...")
+
+
+def import_ratings(conn, ratings_path, rows_done=0, workers=None):
+    """Parses and maps ratings in a process pool while one thread writes them.
+
+    Each byte range is committed, in file order, with the count of lines read so
+    far, so an interrupted import resumes after the last committed range.
+    """
+    workers = workers or IMPORT_WORKERS
+    columns = pd.read_csv(ratings_path, nrows=0).columns.tolist()
+    renames = ratings_columns(columns)
+    if renames is None:
+        print(f"Unrecognised ratings.csv columns: {columns}")
+        return
+    id_index, book_ids = load_book_id_index(conn)
+    if rows_done:
+        print(f"Resuming Ratings import after {rows_done} rows...")
+    else:
+        print("Importing Ratings...")
+    start = skip_lines(ratings_path, rows_done)
+    ranges = list(line_ranges(ratings_path, start, IMPORT_CHUNK_BYTES))
+    worker_args = (ratings_path, columns, renames, id_index, book_ids)
+    writer = RatingsWriter(conn, rows_done, max_pending=2 * workers)
+    writer.start()
+    try:
+        if workers > 1 and len(ranges) > 1:
+            # Spawned rather than forked: the writer thread is already running,
+            # and a fork would copy its connection and any lock it holds
+            with ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_ratings_worker,
+                initargs=worker_args,
+            ) as pool:
+                # Results are handed over in submission order, a few ranges ahead
+                pending = deque()
+                for byte_range in ranges:
+                    if writer.error is not None:
+                        break
+                    pending.append(pool.submit(parse_ratings_range, byte_range))
+                    if len(pending) >= 2 * workers:
+                        writer.batches.put(pending.popleft().result())
+                while pending and writer.error is None:
+                    writer.batches.put(pending.popleft().result())
+                # Once a write has failed, nothing still queued will be used
+                pool.shutdown(cancel_futures=True)
+        else:
+            init_ratings_worker(*worker_args)
+            for byte_range in ranges:
+                if writer.error is not None:
+                    break
+                writer.batches.put(parse_ratings_range(byte_range))
+    finally:
+        writer.batches.put(None)
+        writer.join()
+    if writer.error is not None:
+        raise writer.error
+    conn.execute("UPDATE import_progress SET done = 1 WHERE source = 'ratings'")
     conn.commit()
-    print("Data Import Complete.")
+    report_rate("ratings", writer.imported, writer.started)
 
 
 def get_all_books():
-    conn = get_db_connection()
-    df = pd.read_sql("SELECT * FROM books", conn)
-    conn.close()
-    return df
+    with db_connection() as conn:
+        return pd.read_sql("SELECT * FROM books", conn)
 
 
 def get_all_ratings():
-    conn = get_db_connection()
-    df = pd.read_sql("SELECT * FROM ratings", conn)
-    conn.close()
-    return df
+    with db_connection() as conn:
+        return pd.read_sql("SELECT * FROM ratings ORDER BY rating_id", conn)
+
+
+def get_ratings_since(max_rating_id, data_version):
+    """Ratings added after max_rating_id or written after data_version."""
+    with db_connection() as conn:
+        return pd.read_sql(
+            "SELECT * FROM ratings WHERE rating_id > ? OR change_seq > ? "
+            "ORDER BY rating_id",
+            conn,
+            params=(max_rating_id, data_version),
+        )
+
+
+def count_ratings():
+    with db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM ratings").fetchone()[0]
 
 
 def create_user(username):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
-        conn.commit()
-        user_id = cursor.lastrowid
-        return user_id
-    except sqlite3.IntegrityError:
-        return None
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
+            conn.commit()
+            user_id = cursor.lastrowid
+            return user_id
+        except sqlite3.IntegrityError:
+            return None
 
 
 def get_user_by_username(username):
-    conn = get_db_connection()
-    user = conn.execute(
-        "SELECT * FROM users WHERE username = ?", (username,)
-    ).fetchone()
-    conn.close()
-    return user
+    with db_connection() as conn:
+        return conn.execute(
+            "SELECT * FROM users WHERE username = ?", (username,)
+        ).fetchone()
 
 
 def add_rating(user_id, book_id, rating):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    existing = cursor.execute(
-        "SELECT rating_id FROM ratings WHERE user_id = ? AND book_id = ?",
-        (user_id, book_id),
-    ).fetchone()
-    if existing:
-        cursor.execute(
-            "UPDATE ratings SET rating = ?, timestamp = CURRENT_TIMESTAMP WHERE rating_id = ?",
-            (rating, existing["rating_id"]),
-        )
-    else:
-        cursor.execute(
-            "INSERT INTO ratings (user_id, book_id, rating) VALUES (?, ?, ?)",
+    """Inserts or updates a rating, stamping it with the data version it creates.
+
+    Unlike the timestamp, which only resolves seconds, change_seq tells apart
+    every write, so a trainer can find exactly the ratings it has not seen.
+    """
+    with db_connection() as conn:
+        bump_data_version(conn)
+        conn.execute(
+            """
+            INSERT INTO ratings (user_id, book_id, rating, change_seq)
+            SELECT ?, ?, ?, version FROM data_version WHERE id = 0
+            ON CONFLICT (user_id, book_id) DO UPDATE SET
+                rating = excluded.rating, timestamp = CURRENT_TIMESTAMP,
+                change_seq = excluded.change_seq
+        """,
             (user_id, book_id, rating),
         )
-    conn.commit()
-    conn.close()
+        conn.commit()
 
 
 def get_valid_user_ids():
-    conn = get_db_connection()
-    df = pd.read_sql("SELECT user_id FROM users", conn)
-    conn.close()
+    with db_connection() as conn:
+        df = pd.read_sql("SELECT user_id FROM users", conn)
     return df["user_id"].tolist()
 
 
 def get_user_ratings(user_id):
-    conn = get_db_connection()
-    df = pd.read_sql(
-        "SELECT book_id, rating FROM ratings WHERE user_id = ?", conn, params=(user_id,)
-    )
-    conn.close()
+    with db_connection() as conn:
+        df = pd.read_sql(
+            "SELECT book_id, rating FROM ratings WHERE user_id = ?",
+            conn,
+            params=(user_id,),
+        )
     if df.empty:
         return {}
     return dict(zip(df["book_id"], df["rating"]))
 
 
 def get_system_stats():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    num_books = cursor.execute("SELECT COUNT(*) FROM books").fetchone()[0]
-    num_users = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    num_ratings = cursor.execute("SELECT COUNT(*) FROM ratings").fetchone()[0]
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        num_books = cursor.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+        num_users = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        num_ratings = cursor.execute("SELECT COUNT(*) FROM ratings").fetchone()[0]
     return {"num_books": num_books, "num_users": num_users, "num_ratings": num_ratings}
 
 
 def get_book_average_rating(book_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    avg_rating = cursor.execute(
-        "SELECT AVG(rating) FROM ratings WHERE book_id = ?", (book_id,)
-    ).fetchone()[0]
-    conn.close()
-    if avg_rating is None:
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT average_rating FROM book_rating_stats WHERE book_id = ?", (book_id,)
+        ).fetchone()
+    if row is None or row[0] is None:
         return 0.0
-    return round(avg_rating, 1)
+    return round(row[0], 1)
+
+
+def get_book_average_ratings(book_ids):
+    """Average rating of every book in book_ids, fetched with one query."""
+    book_ids = list(dict.fromkeys(int(book_id) for book_id in book_ids))
+    averages = dict.fromkeys(book_ids, 0.0)
+    with db_connection() as conn:
+        # Stay under SQLite's default limit on bound parameters
+        for start in range(0, len(book_ids), 900):
+            chunk = book_ids[start : start + 900]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT book_id, average_rating FROM book_rating_stats WHERE book_id IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for book_id, avg_rating in rows:
+                averages[book_id] = round(avg_rating, 1)
+    return averages
+
+
+def get_trending_book_ids(limit=10):
+    """The most-rated books, read from the maintained aggregates."""
+    with db_connection() as conn:
+        rows = conn.execute(
+            "SELECT book_id FROM book_rating_stats WHERE rating_count > 0 "
+            "ORDER BY rating_count DESC, book_id LIMIT ?",
+            (limit,),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def request_training(reason, full_retrain=False):
+    """Queues a training job unless one at least as thorough is waiting or running."""
+    with db_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO training_jobs (reason, full_retrain) SELECT ?, ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM training_jobs
+                WHERE status IN ('pending', 'running') AND full_retrain >= ?
+            )
+        """,
+            (reason, int(full_retrain), int(full_retrain)),
+        )
+        conn.commit()
+
+
+def claim_training_job():
+    """Marks the next pending job as running and returns it, or None."""
+    with db_connection() as conn:
+        jobs = conn.execute(
+            """
+            UPDATE training_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP
+            WHERE job_id = (
+                SELECT job_id FROM training_jobs WHERE status = 'pending'
+                ORDER BY full_retrain DESC, job_id LIMIT 1
+            )
+            RETURNING job_id, reason, full_retrain
+        """
+        ).fetchall()
+        conn.commit()
+    return jobs[0] if jobs else None
+
+
+def finish_training_job(job_id, status, error=None):
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE training_jobs SET status = ?, error = ?, "
+            "finished_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+            (status, error, job_id),
+        )
+        conn.commit()
+
+
+def fail_running_training_jobs(error):
+    """Fails jobs left running by a trainer that died mid-job."""
+    with db_connection() as conn:
+        conn.execute(
+            "UPDATE training_jobs SET status = 'failed', error = ?, "
+            "finished_at = CURRENT_TIMESTAMP WHERE status = 'running'",
+            (error,),
+        )
+        conn.commit()
+
+
+def count_ratings_since(max_rating_id, max_change_seq):
+    """Ratings added after max_rating_id or changed after max_change_seq."""
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM ratings WHERE rating_id > ? OR change_seq > ?",
+            (max_rating_id, max_change_seq),
+        ).fetchone()
+    return row[0]
+
+
+def delete_user_recommendations(model_version):
+    with db_connection() as conn:
+        conn.execute(
+            "DELETE FROM user_recommendations WHERE model_version = ?",
+            (model_version,),
+        )
+        conn.commit()
+
+
+def save_user_recommendations(model_version, rows):
+    """Adds a batch of (user_id, rank, book_id, score) rows for a model version.
+
+    rows should be a list: each batch is its own short transaction, so the write
+    lock is never held while the next batch is still being scored.
+    """
+    with db_connection() as conn:
+        conn.executemany(
+            "INSERT INTO user_recommendations "
+            "(model_version, user_id, rank, book_id, score) VALUES (?, ?, ?, ?, ?)",
+            [(model_version, *row) for row in rows],
+        )
+        conn.commit()
+
+
+def prune_user_recommendations(keep_version):
+    """Deletes the recommendations of every model version but keep_version."""
+    with db_connection() as conn:
+        conn.execute(
+            "DELETE FROM user_recommendations WHERE model_version != ?",
+            (keep_version,),
+        )
+        conn.commit()
+
+
+def get_user_recommendations(model_version, user_id, limit=3):
+    """(book_id, score) pairs precomputed for the user, best first."""
+    with db_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT book_id, score FROM user_recommendations
+            WHERE model_version = ? AND user_id = ?
+            ORDER BY rank LIMIT ?
+        """,
+            (model_version, user_id, limit),
+        ).fetchall()
+    return [(row[0], row[1]) for row in rows]
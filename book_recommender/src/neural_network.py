@@ -1,15 +1,27 @@
+import copy
+import math
+import queue
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 import numpy as np
+from ann import ExactIndex, InvertedFileIndex, measure_recall, top_n_rows
+
+MAX_BATCH_SIZE = 4096
+# Small datasets still get enough optimizer steps per epoch to converge
+MIN_STEPS_PER_EPOCH = 64
+# Adam's learning rate was tuned at this batch size; larger batches scale from it
+BASE_LEARNING_RATE = 0.001
+BASE_BATCH_SIZE = 32
 
 
 class RecommenderNet(nn.Module):
-    def __init__(self, num_users, num_books, embedding_size=50):
+    def __init__(self, num_users, num_books, embedding_size=50, sparse=False):
         super(RecommenderNet, self).__init__()
-        self.user_embedding = nn.Embedding(num_users, embedding_size)
-        self.book_embedding = nn.Embedding(num_books, embedding_size)
+        self.user_embedding = nn.Embedding(num_users, embedding_size, sparse=sparse)
+        self.book_embedding = nn.Embedding(num_books, embedding_size, sparse=sparse)
         self.fc1 = nn.Linear(embedding_size * 2, 64)
         self.fc2 = nn.Linear(64, 32)
         self.output = nn.Linear(32, 1)
@@ -25,6 +37,59 @@ class RecommenderNet(nn.Module):
         x = self.relu(self.fc2(x))
         return self.output(x)
 
+    def grow(self, num_users, num_books):
+        """Adds embedding rows for users and books new since the model was trained."""
+        self.user_embedding = grown_embedding(self.user_embedding, num_users)
+        self.book_embedding = grown_embedding(self.book_embedding, num_books)
+        return self
+
+    def set_sparse(self, sparse):
+        """Switches the embeddings between sparse and dense gradients."""
+        self.user_embedding.sparse = sparse
+        self.book_embedding.sparse = sparse
+        return self
+
+    def book_vectors(self):
+        return self.book_embedding.weight.detach()
+
+    def query_vectors(self, user_ids, book):
+        """Each user's rating gradient with respect to the book embedding at book."""
+        with torch.no_grad():
+            users = self.user_embedding.weight[user_ids]
+            x = torch.cat([users, book.expand(len(user_ids), -1)], dim=1)
+            hidden1 = self.fc1(x)
+            hidden2 = self.fc2(self.relu(hidden1))
+            return rating_gradient(
+                hidden1,
+                hidden2,
+                self.fc2.weight,
+                self.output.weight[0],
+                self.fc1.weight[:, users.shape[1] :],
+            )
+
+
+def rating_gradient(hidden1, hidden2, fc2_weight, output_weight, fc1_book_weight):
+    """Backpropagates a rating through the output, fc2 and fc1 layers by hand.
+
+    hidden1 and hidden2 are the pre-ReLU activations; no autograd graph is needed,
+    so this also works on quantized layers.
+    """
+    grad2 = output_weight * (hidden2 > 0).float()
+    grad1 = (grad2 @ fc2_weight) * (hidden1 > 0).float()
+    return grad1 @ fc1_book_weight
+
+
+def grown_embedding(embedding, num_rows):
+    """A copy of embedding with num_rows rows; added rows start at the mean row."""
+    old_rows, dim = embedding.weight.shape
+    if num_rows <= old_rows:
+        return embedding
+    grown = nn.Embedding(num_rows, dim, sparse=embedding.sparse)
+    with torch.no_grad():
+        grown.weight[:old_rows] = embedding.weight
+        grown.weight[old_rows:] = embedding.weight.mean(dim=0)
+    return grown
+
 
 class BookDataset(Dataset):
     def __init__(self, user_ids, book_ids, ratings):
@@ -35,24 +100,432 @@ class BookDataset(Dataset):
     def __len__(self):
         return len(self.ratings)
 
+    def subset(self, indices):
+        return BookDataset(
+            self.user_ids[indices].numpy(),
+            self.book_ids[indices].numpy(),
+            self.ratings[indices].numpy(),
+        )
+
     def __getitem__(self, idx):
         return self.user_ids[idx], self.book_ids[idx], self.ratings[idx]
 
 
-def train_model(model, train_loader, epochs=5, progress_callback=None):
+class BatchLoader:
+    """Yields whole (user_ids, book_ids, ratings) batches by slicing a BookDataset.
+
+    Each epoch draws one random permutation and indexes the dataset's tensors
+    with a slice of it per batch, so there is no per-item fetch or collation.
+    """
+
+    def __init__(self, dataset, batch_size=None, shuffle=True, generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size or default_batch_size(len(dataset))
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(n, generator=self.generator)
+        else:
+            order = torch.arange(n)
+        tensors = (self.dataset.user_ids, self.dataset.book_ids, self.dataset.ratings)
+        for start in range(0, n, self.batch_size):
+            idx = order[start : start + self.batch_size]
+            yield tuple(tensor[idx] for tensor in tensors)
+
+
+def default_batch_size(num_ratings):
+    """The largest power of two giving MIN_STEPS_PER_EPOCH steps, within bounds."""
+    target = max(num_ratings // MIN_STEPS_PER_EPOCH, BASE_BATCH_SIZE)
+    return min(1 << (target.bit_length() - 1), MAX_BATCH_SIZE)
+
+
+def scaled_learning_rate(batch_size):
+    """Square-root scaling of the base learning rate, which suits Adam."""
+    return BASE_LEARNING_RATE * math.sqrt(batch_size / BASE_BATCH_SIZE)
+
+
+def learning_rate_schedule(optimizer, steps_per_epoch, epochs, batch_size):
+    """Linear warmup then cosine decay, for batches larger than the base size.
+
+    The scaled-up rate is too aggressive for freshly initialised weights, so it is
+    reached over the first epoch and then annealed towards the base rate.
+    """
+    total_steps = max(steps_per_epoch * epochs, 1)
+    warmup_steps = min(steps_per_epoch, total_steps // 2)
+    floor = min(BASE_LEARNING_RATE / scaled_learning_rate(batch_size), 1.0)
+
+    def factor(step):
+        if batch_size <= BASE_BATCH_SIZE:
+            return 1.0
+        if step < warmup_steps:
+            return floor + (1 - floor) * (step + 1) / warmup_steps
+        progress = (step - warmup_steps) / max(total_steps - warmup_steps, 1)
+        return floor + (1 - floor) * 0.5 * (1 + math.cos(math.pi * progress))
+
+    return optim.lr_scheduler.LambdaLR(optimizer, factor)
+
+
+def build_optimizers(model, lr, steps_per_epoch, epochs, batch_size):
+    """Optimizers, with their schedules, covering every parameter of model.
+
+    Sparse embeddings need SparseAdam, which only updates the rows a batch
+    touched; the dense MLP layers keep plain Adam.
+    """
+    embeddings = (model.user_embedding, model.book_embedding)
+    if all(embedding.sparse for embedding in embeddings):
+        sparse_params = [embedding.weight for embedding in embeddings]
+        sparse_ids = {id(param) for param in sparse_params}
+        dense_params = [p for p in model.parameters() if id(p) not in sparse_ids]
+        optimizers = [
+            optim.SparseAdam(sparse_params, lr=lr),
+            optim.Adam(dense_params, lr=lr),
+        ]
+    else:
+        optimizers = [optim.Adam(model.parameters(), lr=lr)]
+    schedulers = [
+        learning_rate_schedule(optimizer, steps_per_epoch, epochs, batch_size)
+        for optimizer in optimizers
+    ]
+    return optimizers, schedulers
+
+
+def train_epoch(model, train_loader, optimizers, schedulers):
+    """Runs one pass over train_loader and returns the summed loss as a tensor."""
     criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=0.001)
-    model.train()
-    for epoch in range(epochs):
-        total_loss = 0
-        for user_ids, book_ids, ratings in train_loader:
+    # Summed on-device so the loop never waits on loss.item()
+    total_loss = torch.zeros(())
+    for user_ids, book_ids, ratings in train_loader:
+        for optimizer in optimizers:
             optimizer.zero_grad()
-            outputs = model(user_ids, book_ids).squeeze()
-            loss = criterion(outputs, ratings)
-            loss.backward()
+        outputs = model(user_ids, book_ids).squeeze(1)
+        loss = criterion(outputs, ratings)
+        loss.backward()
+        for optimizer, scheduler in zip(optimizers, schedulers):
             optimizer.step()
-            total_loss += loss.item()
+            scheduler.step()
+        total_loss += loss.detach()
+    return total_loss
+
+
+def train_model(
+    model,
+    train_loader,
+    epochs=5,
+    progress_callback=None,
+    lr=None,
+    sparse=True,
+    num_threads=None,
+    workers=1,
+):
+    """Trains with a learning rate scaled to the loader's batch size unless given.
+
+    sparse gives the embeddings sparse gradients, so a step costs in proportion to
+    the rows its batch touched rather than the size of the tables. num_threads
+    sets torch's intra-op threads, and workers > 1 trains Hogwild-style: that many
+    processes update the model's shared-memory parameters without locking.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model.set_sparse(sparse)
+    batch_size = train_loader.batch_size
+    lr = lr or scaled_learning_rate(batch_size)
+    if workers > 1:
+        return train_hogwild(
+            model, train_loader, epochs, progress_callback, lr, num_threads, workers
+        )
+    optimizers, schedulers = build_optimizers(
+        model, lr, len(train_loader), epochs, batch_size
+    )
+    model.train()
+    for epoch in range(epochs):
+        total_loss = train_epoch(model, train_loader, optimizers, schedulers)
         if progress_callback:
             progress_callback(epoch + 1, epochs)
-        print(f"Epoch {epoch+1}/{epochs}, Loss: {total_loss/len(train_loader):.4f}")
+        report_epoch(epoch, epochs, total_loss.item() / len(train_loader))
+    return model
+
+
+def report_epoch(epoch, epochs, loss):
+    print(f"Epoch {epoch+1}/{epochs}, Loss: {loss:.4f}")
+
+
+def hogwild_worker(model, shard, batch_size, epochs, lr, num_threads, reports):
+    """Trains on one shard of the data, reporting (loss, steps) after each epoch."""
+    torch.set_num_threads(num_threads)
+    train_loader = BatchLoader(shard, batch_size=batch_size)
+    optimizers, schedulers = build_optimizers(
+        model, lr, len(train_loader), epochs, batch_size
+    )
+    model.train()
+    for _ in range(epochs):
+        total_loss = train_epoch(model, train_loader, optimizers, schedulers)
+        reports.put((total_loss.item(), len(train_loader)))
+
+
+def train_hogwild(
+    model, train_loader, epochs, progress_callback, lr, num_threads, workers
+):
+    """Trains with workers processes sharing model's parameters (Hogwild).
+
+    Each process takes a disjoint random shard of the data and keeps its own
+    optimizer state, writing straight into the shared weights.
+    """
+    dataset = train_loader.dataset
+    threads = max((num_threads or torch.get_num_threads()) // workers, 1)
+    model.share_memory()
+    context = mp.get_context()
+    reports = context.Queue()
+    shards = torch.randperm(len(dataset)).chunk(workers)
+    processes = [
+        context.Process(
+            target=hogwild_worker,
+            args=(
+                model,
+                dataset.subset(shard),
+                train_loader.batch_size,
+                epochs,
+                lr,
+                threads,
+                reports,
+            ),
+        )
+        for shard in shards
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for epoch in range(epochs):
+            total_loss, steps = 0.0, 0
+            for _ in processes:
+                loss, count = next_report(reports, processes)
+                total_loss += loss
+                steps += count
+            if progress_callback:
+                progress_callback(epoch + 1, epochs)
+            report_epoch(epoch, epochs, total_loss / max(steps, 1))
+    finally:
+        for process in processes:
+            process.join()
     return model
+
+
+def next_report(reports, processes):
+    """The next worker report, failing fast if any worker has died."""
+    while True:
+        try:
+            return reports.get(timeout=1)
+        except queue.Empty:
+            failed = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+            if failed:
+                for process in processes:
+                    process.terminate()
+                raise RuntimeError(f"Hogwild worker exited with code {failed[0]}")
+
+
+def fine_tune_model(
+    model,
+    user_ids,
+    book_ids,
+    ratings,
+    new_rows,
+    replay_ratio=4,
+    epochs=3,
+    batch_size=None,
+    progress_callback=None,
+    seed=None,
+    **train_options,
+):
+    """Fine-tunes a trained model on new_rows plus a replayed sample of older rows.
+
+    Replaying old interactions alongside the new ones keeps a short update from
+    overwriting what the model has already learned. train_options are passed on
+    to train_model.
+    """
+    rng = np.random.default_rng(seed)
+    is_old = np.ones(len(ratings), dtype=bool)
+    is_old[new_rows] = False
+    old_rows = np.flatnonzero(is_old)
+    replay = rng.choice(
+        old_rows, size=min(len(old_rows), replay_ratio * len(new_rows)), replace=False
+    )
+    rows = np.concatenate([new_rows, replay])
+    dataset = BookDataset(user_ids[rows], book_ids[rows], ratings[rows])
+    train_loader = BatchLoader(dataset, batch_size=batch_size)
+    return train_model(model, train_loader, epochs, progress_callback, **train_options)
+
+
+class TwoStageRecommender:
+    """Top books for a user without scoring the whole catalog with the MLP.
+
+    Candidates come from an inner-product index over the book embeddings plus
+    the most popular books, and only those are reranked by the model. The model
+    scores concatenated embeddings, not their dot product, so the query is the
+    gradient of the user's predicted rating with respect to the book embedding,
+    taken at the mean book: a first-order estimate of which books score highest.
+
+    model is a RecommenderNet or an exported InferenceNet.
+    """
+
+    def __init__(
+        self, model, popularity, index=None, num_candidates=300, num_popular=50
+    ):
+        self.model = model.eval()
+        self.num_candidates = num_candidates
+        book_vectors = model.book_vectors()
+        self.mean_book = book_vectors.float().mean(dim=0)
+        # Half-precision tables stay half; the index scores candidate rows in float
+        book_vectors = book_vectors.numpy()
+        self.index = (index or InvertedFileIndex()).build(book_vectors)
+        self.popular = np.argsort(-np.asarray(popularity), kind="stable")[:num_popular]
+
+    def query_vectors(self, users):
+        users = torch.from_numpy(np.asarray(users, dtype=np.int64))
+        return self.model.query_vectors(users, self.mean_book).numpy()
+
+    def candidates(self, users):
+        """Candidate book positions per user; a popular book may appear twice."""
+        found, _ = self.index.search_batch(
+            self.query_vectors(users), self.num_candidates
+        )
+        popular = np.broadcast_to(self.popular, (len(users), len(self.popular)))
+        return np.sort(np.hstack([found, popular]), axis=1)
+
+    def recommend_batch(self, users, top_n=3):
+        """(book positions, predicted ratings) per user, best first, one row each."""
+        users = np.asarray(users, dtype=np.int64)
+        candidates = self.candidates(users)
+        book_ids = torch.from_numpy(candidates.astype(np.int64))
+        user_ids = torch.from_numpy(users)[:, None].expand_as(book_ids)
+        with torch.no_grad():
+            scores = self.model(user_ids.reshape(-1), book_ids.reshape(-1))
+        scores = scores.reshape(candidates.shape).numpy()
+        # Candidates are sorted, so a repeat sits right after its first copy
+        scores[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -np.inf
+        top = top_n_rows(scores, top_n)
+        return (
+            np.take_along_axis(candidates, top, axis=1),
+            np.take_along_axis(scores, top, axis=1),
+        )
+
+    def recommend(self, user_encoded, top_n=3):
+        """(book positions, predicted ratings) of the user's top_n books, best first."""
+        top, scores = self.recommend_batch([user_encoded], top_n)
+        return top[0], scores[0]
+
+    def candidate_recall(self, users):
+        """How much of each user's exact top num_candidates the index retrieves."""
+        reference = ExactIndex().build(self.index.matrix)
+        return measure_recall(
+            self.index, reference, self.query_vectors(users), self.num_candidates
+        )
+
+
+class InferenceNet(nn.Module):
+    """A trained RecommenderNet repacked for serving.
+
+    The embedding tables are stored as float16, or as int8 with a scale per row,
+    and are widened to float32 only for the rows a batch looks up. Dropout is
+    dropped, and export_inference_model can quantize fc1 and fc2 afterwards.
+    """
+
+    def __init__(self, model, embedding_dtype="float16"):
+        super(InferenceNet, self).__init__()
+        self.half_precision = embedding_dtype == "float16"
+        for name, embedding in (
+            ("user", model.user_embedding),
+            ("book", model.book_embedding),
+        ):
+            rows, scales = compress_embedding(
+                embedding.weight.detach(), embedding_dtype
+            )
+            self.register_buffer(f"{name}_rows", rows)
+            self.register_buffer(f"{name}_scales", scales)
+        self.embedding_size = model.user_embedding.embedding_dim
+        self.fc1 = copy.deepcopy(model.fc1)
+        self.fc2 = copy.deepcopy(model.fc2)
+        self.output = copy.deepcopy(model.output)
+        # Float copies for rating_gradient, which can't read quantized weights
+        self.register_buffer(
+            "fc1_book_weight",
+            self.fc1.weight[:, self.embedding_size :].detach().clone(),
+        )
+        self.register_buffer("fc2_weight", self.fc2.weight.detach().clone())
+        self.register_buffer("output_weight", self.output.weight[0].detach().clone())
+
+    def forward(self, user_ids, book_ids):
+        users = self.embed(self.user_rows, self.user_scales, user_ids)
+        books = self.embed(self.book_rows, self.book_scales, book_ids)
+        x = torch.relu(self.fc1(torch.cat([users, books], dim=1)))
+        x = torch.relu(self.fc2(x))
+        return self.output(x)
+
+    def embed(self, rows, scales, ids):
+        if self.half_precision:
+            return rows[ids].float()
+        return rows[ids].float() * scales[ids].unsqueeze(1)
+
+    @torch.jit.export
+    def book_vectors(self):
+        if self.half_precision:
+            return self.book_rows
+        return self.book_rows.float() * self.book_scales.unsqueeze(1)
+
+    @torch.jit.export
+    def query_vectors(self, user_ids, book):
+        users = self.embed(self.user_rows, self.user_scales, user_ids)
+        x = torch.cat([users, book.expand(user_ids.shape[0], -1)], dim=1)
+        hidden1 = self.fc1(x)
+        hidden2 = self.fc2(torch.relu(hidden1))
+        return rating_gradient(
+            hidden1, hidden2, self.fc2_weight, self.output_weight, self.fc1_book_weight
+        )
+
+
+def compress_embedding(weight, embedding_dtype):
+    """(rows, per-row scales) storing weight as float16 or symmetric int8."""
+    if embedding_dtype == "float16":
+        return weight.half(), torch.empty(0)
+    if embedding_dtype == "int8":
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        rows = torch.round(weight / scales.unsqueeze(1)).to(torch.int8)
+        return rows, scales
+    raise ValueError(f"Unsupported embedding dtype: {embedding_dtype}")
+
+
+def export_inference_model(model, quantize=False, embedding_dtype="float16"):
+    """model as a frozen TorchScript InferenceNet, with int8 fc1/fc2 if quantize.
+
+    Dynamic quantization pays off only when the int8 matmuls outweigh quantizing
+    each batch's activations, which these narrow layers don't reach on every CPU.
+    """
+    exported = InferenceNet(model, embedding_dtype).eval()
+    if quantize:
+        # A scale per output channel trims the int8 error a little further
+        qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+        exported = torch.ao.quantization.quantize_dynamic(
+            exported, {"fc1": qconfig, "fc2": qconfig}, dtype=torch.qint8
+        )
+    return torch.jit.freeze(
+        torch.jit.script(exported), preserved_attrs=["book_vectors", "query_vectors"]
+    )
+
+
+def inference_parity(model, exported, num_samples=10000, seed=0):
+    """How far exported's predicted ratings stray from model's on random pairs."""
+    generator = torch.Generator().manual_seed(seed)
+    user_ids = torch.randint(
+        model.user_embedding.num_embeddings, (num_samples,), generator=generator
+    )
+    book_ids = torch.randint(
+        model.book_embedding.num_embeddings, (num_samples,), generator=generator
+    )
+    model.eval()
+    with torch.no_grad():
+        errors = (model(user_ids, book_ids) - exported(user_ids, book_ids)).abs()
+    return {"max_error": errors.max().item(), "mean_error": errors.mean().item()}
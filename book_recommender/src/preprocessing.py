@@ -1,22 +1,275 @@
-from database import get_all_books, get_all_ratings, init_db
+import os
+import threading
+import numpy as np
+import pandas as pd
+from artifacts import publish_directory
+from database import (
+    DATA_DIR,
+    count_ratings,
+    get_all_books,
+    get_all_ratings,
+    get_books_version,
+    get_data_version,
+    get_ratings_since,
+    init_db,
+)
+
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshot")
+BOOKS_SNAPSHOT_DIR = os.path.join(SNAPSHOT_DIR, "books")
+RATINGS_SNAPSHOT_DIR = os.path.join(SNAPSHOT_DIR, "ratings")
+# Ratings written since the snapshot are applied on load until they are this
+# share of it; past that a new snapshot is taken
+RESNAPSHOT_FRACTION = 0.05
+VOCAB_PATH = os.path.join(DATA_DIR, "id_vocab.npz")
+RATINGS_DTYPES = {
+    "rating_id": np.int64,
+    "user_id": np.int32,
+    "book_id": np.int32,
+    "rating": np.int16,
+    "timestamp": "datetime64[s]",
+    "change_seq": np.int64,
+}
 
 
 def load_data():
-    """Loads books and ratings data from the database."""
+    """Loads books and ratings data, from snapshots kept separately for each.
+
+    Books are snapshotted per books version, which only imports bump. A new
+    rating does not invalidate the ratings snapshot: the rows written since it
+    was taken are read on top of it.
+    """
     init_db()
+    return load_books(), load_ratings()
+
+
+def load_books():
+    path = os.path.join(BOOKS_SNAPSHOT_DIR, f"v{get_books_version()}")
+    if os.path.isdir(path):
+        try:
+            return load_books_snapshot(path)
+        except Exception as e:
+            print(f"Error loading books snapshot: {e}")
     books = get_all_books()
-    ratings = get_all_ratings()
-    return books, ratings
-
-
-def prepare_data_for_nn(ratings_df):
-    """Encodes user and book IDs for the neural network."""
-    user_ids = ratings_df["user_id"].unique().tolist()
-    book_ids = ratings_df["book_id"].unique().tolist()
-    user2user_encoded = {x: i for i, x in enumerate(user_ids)}
-    book2book_encoded = {x: i for i, x in enumerate(book_ids)}
-    ratings_df["user_encoded"] = ratings_df["user_id"].map(user2user_encoded)
-    ratings_df["book_encoded"] = ratings_df["book_id"].map(book2book_encoded)
-    num_users = len(user2user_encoded)
-    num_books = len(book2book_encoded)
-    return ratings_df, num_users, num_books, user2user_encoded, book2book_encoded
+    save_books_snapshot(path, books)
+    return books
+
+
+def load_ratings():
+    version = get_data_version()
+    snapshot_version = latest_ratings_snapshot(version)
+    if snapshot_version is not None:
+        try:
+            snapshot = load_ratings_snapshot(
+                os.path.join(RATINGS_SNAPSHOT_DIR, f"v{snapshot_version}")
+            )
+            if snapshot_version == version:
+                return snapshot
+            ratings, changed = apply_rating_changes(snapshot, snapshot_version)
+            if ratings is not None:
+                if changed > RESNAPSHOT_FRACTION * len(snapshot):
+                    save_ratings_snapshot(
+                        os.path.join(RATINGS_SNAPSHOT_DIR, f"v{version}"), ratings
+                    )
+                return ratings
+        except Exception as e:
+            print(f"Error loading ratings snapshot: {e}")
+    # Read the version first: rows written meanwhile are read again next time
+    ratings = pd.DataFrame(ratings_columns(get_all_ratings()), copy=False)
+    save_ratings_snapshot(os.path.join(RATINGS_SNAPSHOT_DIR, f"v{version}"), ratings)
+    return ratings
+
+
+def latest_ratings_snapshot(version):
+    """The newest ratings snapshot version not past version, or None."""
+    try:
+        entries = os.listdir(RATINGS_SNAPSHOT_DIR)
+    except OSError:
+        return None
+    versions = [
+        int(entry[1:])
+        for entry in entries
+        if entry.startswith("v") and entry[1:].isdigit()
+    ]
+    return max((v for v in versions if v <= version), default=None)
+
+
+def apply_rating_changes(snapshot, snapshot_version):
+    """The snapshot with ratings added or updated since snapshot_version applied.
+
+    Returns (ratings, number of changed rows), or (None, 0) when ratings were
+    deleted meanwhile, which only a full read picks up.
+    """
+    snapshot_ids = snapshot["rating_id"].to_numpy()
+    max_rating_id = int(snapshot_ids[-1]) if len(snapshot_ids) else -1
+    changes = ratings_columns(get_ratings_since(max_rating_id, snapshot_version))
+    change_ids = changes["rating_id"]
+    if not len(change_ids):
+        ratings = snapshot
+    else:
+        # Both are in rating_id order, and new ratings get ids past the snapshot's
+        positions = np.searchsorted(snapshot_ids, change_ids)
+        updated = positions < len(snapshot_ids)
+        updated[updated] = snapshot_ids[positions[updated]] == change_ids[updated]
+        columns = {}
+        for name, values in changes.items():
+            column = np.array(snapshot[name])
+            column[positions[updated]] = values[updated]
+            columns[name] = np.concatenate([column, values[~updated]])
+        ratings = pd.DataFrame(columns, copy=False)
+    if len(ratings) != count_ratings():
+        return None, 0
+    return ratings, len(change_ids)
+
+
+def ratings_columns(ratings_df):
+    """The ratings as narrow NumPy columns, the form they are snapshotted in."""
+    columns = {}
+    for name, dtype in RATINGS_DTYPES.items():
+        values = ratings_df[name]
+        if name == "timestamp":
+            values = pd.to_datetime(values, errors="coerce")
+        columns[name] = values.to_numpy(dtype)
+    return columns
+
+
+def save_books_snapshot(path, books_df):
+    """Writes books as Parquet (or a pickle without pyarrow)."""
+
+    def write(tmp_path):
+        try:
+            books_df.to_parquet(os.path.join(tmp_path, "books.parquet"), index=False)
+        except ImportError:
+            books_df.to_pickle(os.path.join(tmp_path, "books.pkl"))
+
+    try:
+        # Only the snapshot of the current books version is worth keeping
+        publish_directory(path, write)
+    except Exception as e:
+        print(f"Error saving books snapshot: {e}")
+
+
+def save_ratings_snapshot(path, ratings_df):
+    """Writes ratings as one .npy file per column, then swaps the directory in
+    whole."""
+
+    def write(tmp_path):
+        for name, values in ratings_columns(ratings_df).items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+
+    try:
+        publish_directory(path, write)
+    except Exception as e:
+        print(f"Error saving ratings snapshot: {e}")
+
+
+def load_books_snapshot(path):
+    books_path = os.path.join(path, "books.parquet")
+    if os.path.exists(books_path):
+        return pd.read_parquet(books_path)
+    return pd.read_pickle(os.path.join(path, "books.pkl"))
+
+
+def load_ratings_snapshot(path):
+    """Memory-maps the ratings columns."""
+    return pd.DataFrame(
+        {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in RATINGS_DTYPES
+        },
+        copy=False,
+    )
+
+
+class IdEncoder:
+    """Maps raw IDs to dense int32 codes, in first-seen order, and back.
+
+    Codes are positions in the ids array, so decoding is plain array indexing.
+    """
+
+    def __init__(self, ids):
+        self.ids = np.asarray(ids)
+        self.index = pd.Index(self.ids)
+
+    @classmethod
+    def fit(cls, values):
+        """Encodes values, returning their int32 codes and the encoder."""
+        codes, uniques = pd.factorize(values)
+        return codes.astype(np.int32), cls(uniques)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, raw_id):
+        return raw_id in self.index
+
+    def get(self, raw_id, default=None):
+        """The code of a single raw ID, or default when it was never seen."""
+        try:
+            return int(self.index.get_loc(raw_id))
+        except KeyError:
+            return default
+
+    def encode(self, raw_ids):
+        """Codes of many raw IDs at once; unseen IDs encode to -1."""
+        return self.index.get_indexer(raw_ids).astype(np.int32)
+
+    def decode(self, codes):
+        return self.ids[codes]
+
+    def extend(self, values):
+        """An encoder with the unseen IDs in values appended, in first-seen order."""
+        values = pd.unique(np.asarray(values))
+        unseen = values[self.index.get_indexer(values) < 0]
+        if not len(unseen):
+            return self
+        return IdEncoder(np.concatenate([self.ids, unseen]))
+
+
+_vocab_lock = threading.Lock()
+
+
+def load_vocabulary(path=VOCAB_PATH):
+    """The persisted (user_encoder, book_encoder), or None before the first save."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as vocab:
+        return IdEncoder(vocab["user_ids"]), IdEncoder(vocab["book_ids"])
+
+
+def save_vocabulary(user_encoder, book_encoder, path=VOCAB_PATH):
+    try:
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        np.savez(tmp_path, user_ids=user_encoder.ids, book_ids=book_encoder.ids)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Error saving ID vocabulary: {e}")
+
+
+def prepare_data_for_nn(ratings_df, vocab_path=VOCAB_PATH):
+    """Encodes user and book IDs for the neural network.
+
+    Codes come from the vocabulary saved next to the model weights, which only
+    ever appends new IDs, so a saved embedding row always means the same user or
+    book.
+    """
+    user_ids = ratings_df["user_id"].to_numpy()
+    book_ids = ratings_df["book_id"].to_numpy()
+    with _vocab_lock:
+        try:
+            vocab = load_vocabulary(vocab_path)
+        except Exception as e:
+            print(f"Error loading ID vocabulary: {e}")
+            vocab = None
+        if vocab is None:
+            vocab = IdEncoder.fit(user_ids)[1], IdEncoder.fit(book_ids)[1]
+            sizes = None
+        else:
+            sizes = len(vocab[0]), len(vocab[1])
+        user_encoder, book_encoder = vocab[0].extend(user_ids), vocab[1].extend(
+            book_ids
+        )
+        if sizes != (len(user_encoder), len(book_encoder)):
+            save_vocabulary(user_encoder, book_encoder, vocab_path)
+    ratings_df["user_encoded"] = user_encoder.encode(user_ids)
+    ratings_df["book_encoded"] = book_encoder.encode(book_ids)
+    return ratings_df, len(user_encoder), len(book_encoder), user_encoder, book_encoder
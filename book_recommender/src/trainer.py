@@ -0,0 +1,444 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+import torch
+from artifacts import publish_directory
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from database import (
+    DATA_DIR,
+    claim_training_job,
+    count_ratings_since,
+    delete_user_recommendations,
+    fail_running_training_jobs,
+    finish_training_job,
+    get_data_version,
+    prune_user_recommendations,
+    request_training,
+    save_user_recommendations,
+)
+from neural_network import (
+    BatchLoader,
+    BookDataset,
+    RecommenderNet,
+    TwoStageRecommender,
+    export_inference_model,
+    fine_tune_model,
+    inference_parity,
+    train_model,
+)
+from preprocessing import load_data, prepare_data_for_nn
+
+MODELS_DIR = os.path.join(DATA_DIR, "models")
+LATEST_PATH = os.path.join(MODELS_DIR, "LATEST")
+HEARTBEAT_PATH = os.path.join(MODELS_DIR, "trainer.heartbeat")
+# Held by the running trainer for its whole life; the OS releases it on exit
+LOCK_PATH = os.path.join(MODELS_DIR, "trainer.lock")
+# The model shipped with the repo, served as version 0 until a trainer publishes one
+LEGACY_MODEL_PATH = os.path.join(DATA_DIR, "model.pth")
+LEGACY_META_PATH = os.path.join(DATA_DIR, "model_metadata.json")
+KEEP_VERSIONS = 3
+HEARTBEAT_INTERVAL = 5
+FULL_RETRAIN_EVERY = 24 * 3600
+RECOMMENDATIONS_PER_USER = 10
+# How each version is exported for serving; the command line can change these
+EXPORT_OPTIONS = {"quantize": False, "embedding_dtype": "float16"}
+# Largest predicted-rating difference an export may show against the float model
+PARITY_TOLERANCE = 0.1
+# Passed to train_model; the command line can raise workers and threads
+TRAIN_OPTIONS = {"sparse": True, "num_threads": None, "workers": 1}
+
+
+def model_files(version):
+    """(weights path, metadata path) of a published model version."""
+    if version == 0:
+        return LEGACY_MODEL_PATH, LEGACY_META_PATH
+    path = os.path.join(MODELS_DIR, f"v{version}")
+    return os.path.join(path, "model.pth"), os.path.join(path, "metadata.json")
+
+
+def exported_model_path(version):
+    return os.path.join(os.path.dirname(model_files(version)[0]), "model.ts")
+
+
+def latest_version():
+    """The version serving processes should use, or None before any model exists."""
+    try:
+        with open(LATEST_PATH, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return 0 if os.path.exists(LEGACY_MODEL_PATH) else None
+
+
+def load_model_metadata(version):
+    try:
+        with open(model_files(version)[1], "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def load_model(version, num_users, num_books):
+    """Loads a model version grown to the current vocabulary, or None if it can't be.
+
+    The ID vocabulary only appends, so saved rows stay valid as it grows.
+    """
+    try:
+        state = torch.load(model_files(version)[0])
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        return None
+    trained_users = state["user_embedding.weight"].shape[0]
+    trained_books = state["book_embedding.weight"].shape[0]
+    if trained_users > num_users or trained_books > num_books:
+        print("Saved model does not match the ID vocabulary.")
+        return None
+    model = RecommenderNet(trained_users, trained_books)
+    model.load_state_dict(state)
+    model.grow(num_users, num_books)
+    model.eval()
+    return model
+
+
+def load_serving_model(version, num_users, num_books):
+    """The version's TorchScript export if it covers the vocabulary, else load_model.
+
+    An export can't grow, so users and books new since it was trained need the
+    float model until the next version is published.
+    """
+    path = exported_model_path(version)
+    meta = load_model_metadata(version)
+    covers = (
+        meta.get("num_users", 0) >= num_users and meta.get("num_books", 0) >= num_books
+    )
+    if os.path.exists(path) and covers:
+        try:
+            return torch.jit.load(path)
+        except Exception as e:
+            print(f"Error loading exported model: {e}")
+    return load_model(version, num_users, num_books)
+
+
+def new_rating_rows(ratings, meta):
+    """Positions of ratings added or changed since the model was last trained."""
+    if "max_rating_id" not in meta:
+        return np.empty(0, dtype=np.intp)
+    # Imports insert without a change_seq, so new rows are caught by rating_id
+    changed = ratings["change_seq"].to_numpy() > meta.get("max_change_seq", 0)
+    added = ratings["rating_id"].to_numpy() > meta["max_rating_id"]
+    return np.flatnonzero(changed | added)
+
+
+def version_number(path):
+    return int(os.path.basename(path)[1:])
+
+
+def publish_model(model, ratings, version, full_trained_at):
+    """Writes a new version directory, then repoints LATEST at it in one rename."""
+    trained_until = ratings["timestamp"].max()
+    meta = {
+        "num_ratings": len(ratings),
+        "num_users": model.user_embedding.num_embeddings,
+        "num_books": model.book_embedding.num_embeddings,
+        "trained_until": None if pd.isna(trained_until) else str(trained_until),
+        "max_rating_id": int(ratings["rating_id"].max()),
+        "max_change_seq": int(ratings["change_seq"].max()),
+        "trained_at": time.time(),
+        "full_trained_at": full_trained_at,
+    }
+
+    def write(tmp_path):
+        torch.save(model.state_dict(), os.path.join(tmp_path, "model.pth"))
+        exported = export_inference_model(model, **EXPORT_OPTIONS)
+        meta["parity"] = inference_parity(model, exported)
+        print(f"Exported model parity: {meta['parity']}")
+        if meta["parity"]["max_error"] <= PARITY_TOLERANCE:
+            torch.jit.save(exported, os.path.join(tmp_path, "model.ts"))
+        else:
+            print(
+                "Export is too far from the float model; "
+                "serving will use the float model."
+            )
+        with open(os.path.join(tmp_path, "metadata.json"), "w") as f:
+            json.dump(meta, f)
+
+    # Older versions stay around briefly for processes still loading them
+    publish_directory(
+        os.path.join(MODELS_DIR, f"v{version}"),
+        write,
+        keep=KEEP_VERSIONS,
+        order_key=version_number,
+    )
+    with open(f"{LATEST_PATH}.tmp-{os.getpid()}", "w") as f:
+        f.write(str(version))
+    os.replace(f"{LATEST_PATH}.tmp-{os.getpid()}", LATEST_PATH)
+
+
+def train_version(version, full_retrain=False):
+    """Trains on the current data and publishes the result as version."""
+    books, ratings = load_data()
+    ratings, num_users, num_books, user_encoder, book_encoder = prepare_data_for_nn(
+        ratings
+    )
+    model, meta = None, {}
+    current = latest_version()
+    if not full_retrain and current is not None:
+        model = load_model(current, num_users, num_books)
+        meta = load_model_metadata(current)
+    if model is None:
+        model = RecommenderNet(num_users, num_books)
+        dataset = BookDataset(
+            ratings["user_encoded"].values,
+            ratings["book_encoded"].values,
+            ratings["rating"].values,
+        )
+        train_loader = BatchLoader(dataset)
+        train_model(model, train_loader, epochs=5, **TRAIN_OPTIONS)
+        full_trained_at = time.time()
+    else:
+        new_rows = new_rating_rows(ratings, meta)
+        if len(new_rows):
+            print(f"Fine-tuning on {len(new_rows)} new ratings...")
+            fine_tune_model(
+                model,
+                ratings["user_encoded"].values,
+                ratings["book_encoded"].values,
+                ratings["rating"].values,
+                new_rows,
+                sparse=TRAIN_OPTIONS["sparse"],
+                num_threads=TRAIN_OPTIONS["num_threads"],
+            )
+        full_trained_at = meta.get("full_trained_at", time.time())
+    precompute_recommendations(model, ratings, version, user_encoder, book_encoder)
+    publish_model(model, ratings, version, full_trained_at)
+    # Only now that LATEST points past them are older versions' picks unused
+    prune_user_recommendations(version)
+    print(f"Published model version {version}.")
+    return version
+
+
+def precompute_recommendations(
+    model,
+    ratings,
+    version,
+    user_encoder,
+    book_encoder,
+    top_n=RECOMMENDATIONS_PER_USER,
+    batch_size=1024,
+):
+    """Stores every user's top_n picks under version, scored a batch of users at once.
+
+    The version isn't served until LATEST points at it, so each batch is committed
+    as soon as it is scored rather than holding the write lock for the whole run.
+    """
+    started = time.perf_counter()
+    popularity = np.bincount(ratings["book_encoded"], minlength=len(book_encoder))
+    picks = TwoStageRecommender(model, popularity)
+    users = np.arange(len(user_encoder))
+    if not picks.index.exact:
+        sample = np.random.default_rng(0).choice(users, min(len(users), 100), False)
+        recall = picks.candidate_recall(sample)
+        print(
+            f"Candidate recall@{picks.num_candidates}: {recall['recall']:.3f} "
+            f"({recall['index_ms']:.1f}ms vs {recall['exact_ms']:.1f}ms exact)"
+        )
+    # Leftovers of an earlier attempt at this version
+    delete_user_recommendations(version)
+    for start in range(0, len(users), batch_size):
+        batch = users[start : start + batch_size]
+        top, scores = picks.recommend_batch(batch, top_n)
+        user_ids = user_encoder.decode(batch)
+        book_ids = book_encoder.decode(top.ravel()).reshape(top.shape)
+        save_user_recommendations(
+            version,
+            [
+                (int(user_id), rank, int(book_id), float(score))
+                for user_id, user_books, user_scores in zip(user_ids, book_ids, scores)
+                for rank, (book_id, score) in enumerate(zip(user_books, user_scores))
+            ],
+        )
+    elapsed = time.perf_counter() - started
+    print(f"Precomputed picks for {len(users)} users in {elapsed:.1f}s.")
+
+
+def training_due(min_new_ratings, full_every):
+    """(reason, full_retrain) when the published model is due an update, else None."""
+    version = latest_version()
+    if version is None:
+        return "no model yet", True
+    meta = load_model_metadata(version)
+    if "trained_until" not in meta:
+        # A model saved before versioning: republish it with its rating markers
+        return "adopting saved model", False
+    new_ratings = count_ratings_since(
+        meta.get("max_rating_id", -1), meta.get("max_change_seq", 0)
+    )
+    if not new_ratings:
+        return None
+    if time.time() - meta.get("full_trained_at", time.time()) > full_every:
+        return "scheduled full retrain", True
+    if new_ratings >= min_new_ratings:
+        return f"{new_ratings} new ratings", False
+    return None
+
+
+def run_once(min_new_ratings=1, full_every=FULL_RETRAIN_EVERY, check_due=True):
+    """Runs the next queued job, or a due update; returns the version published."""
+    job = claim_training_job()
+    if job is None:
+        if not check_due:
+            return None
+        due = training_due(min_new_ratings, full_every)
+        if due is None:
+            return None
+        request_training(*due)
+        job = claim_training_job()
+        if job is None:
+            return None
+    job_id, reason, full_retrain = job
+    print(f"Training job {job_id}: {reason}")
+    try:
+        version = train_version(job_id, bool(full_retrain))
+    except Exception as e:
+        print(f"Error training model: {e}")
+        finish_training_job(job_id, "failed", str(e))
+        return None
+    finish_training_job(job_id, "done")
+    return version
+
+
+def acquire_trainer_lock():
+    """The locked LOCK_PATH file, or None if another trainer holds the lock."""
+    lock_file = open(LOCK_PATH, "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def trainer_alive():
+    try:
+        age = time.time() - os.path.getmtime(HEARTBEAT_PATH)
+    except OSError:
+        return False
+    return age < 3 * HEARTBEAT_INTERVAL
+
+
+def beat(stop):
+    while not stop.is_set():
+        with open(HEARTBEAT_PATH, "a"):
+            os.utime(HEARTBEAT_PATH)
+        stop.wait(HEARTBEAT_INTERVAL)
+
+
+def run(
+    poll_interval=10,
+    min_new_ratings=1,
+    full_every=FULL_RETRAIN_EVERY,
+    watch_stdin=False,
+):
+    """Polls for training work until stopped, or until stdin closes if watched."""
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    # The heartbeat only saves spawning a trainer; the lock is what keeps a second
+    # one from failing the jobs of the first
+    lock_file = acquire_trainer_lock()
+    if lock_file is None:
+        print("Another trainer is already running.")
+        return
+    stop = threading.Event()
+    threading.Thread(target=beat, args=(stop,), daemon=True).start()
+    if watch_stdin:
+        # The app holds the other end of stdin; EOF means its server has exited
+        threading.Thread(
+            target=lambda: (sys.stdin.read(), stop.set()), daemon=True
+        ).start()
+    fail_running_training_jobs("trainer restarted")
+    checked_version = None
+    while not stop.is_set():
+        try:
+            # Counting new ratings scans the table, so only do it after a write
+            data_version = get_data_version()
+            run_once(min_new_ratings, full_every, data_version != checked_version)
+            checked_version = data_version
+        except Exception as e:
+            print(f"Error in training loop: {e}")
+        stop.wait(poll_interval)
+    # Let the next server start a trainer straight away
+    try:
+        os.remove(HEARTBEAT_PATH)
+    except OSError:
+        pass
+    lock_file.close()
+
+
+_process = None
+_process_lock = threading.Lock()
+
+
+def ensure_trainer_running():
+    """Starts a trainer for this server process unless one is already running."""
+    global _process
+    with _process_lock:
+        if trainer_alive() or (_process is not None and _process.poll() is None):
+            return
+        os.makedirs(MODELS_DIR, exist_ok=True)
+        log = open(os.path.join(MODELS_DIR, "trainer.log"), "a")
+        _process = subprocess.Popen(
+            [sys.executable, "-u", os.path.abspath(__file__), "--watch-stdin"],
+            stdin=subprocess.PIPE,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Background RecommenderNet trainer")
+    parser.add_argument("--poll-interval", type=float, default=10)
+    parser.add_argument("--min-new-ratings", type=int, default=1)
+    parser.add_argument("--full-every-hours", type=float, default=24)
+    parser.add_argument("--once", action="store_true", help="run one job and exit")
+    parser.add_argument("--watch-stdin", action="store_true")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Hogwild training processes"
+    )
+    parser.add_argument(
+        "--dense", action="store_true", help="train with dense embedding gradients"
+    )
+    parser.add_argument(
+        "--quantize", action="store_true", help="export fc1/fc2 as dynamic int8"
+    )
+    parser.add_argument(
+        "--embedding-dtype", choices=["float16", "int8"], default="float16"
+    )
+    args = parser.parse_args()
+    EXPORT_OPTIONS.update(quantize=args.quantize, embedding_dtype=args.embedding_dtype)
+    TRAIN_OPTIONS.update(
+        sparse=not args.dense, num_threads=args.threads, workers=args.workers
+    )
+    if args.once:
+        run_once(args.min_new_ratings, args.full_every_hours * 3600)
+    else:
+        run(
+            args.poll_interval,
+            args.min_new_ratings,
+            args.full_every_hours * 3600,
+            args.watch_stdin,
+        )